@@ -0,0 +1,199 @@
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+
+# sqlite file shared by the uvicorn workers of one host, without it every worker keeps its own limits
+ADMISSION_DB = os.environ.get("ADMISSION_DB", "")
+# messages per second an account may publish, and how many it may send at once after being idle; 0 turns the limit off
+ACCOUNT_RATE = float(os.environ.get("ACCOUNT_RATE", 50))
+ACCOUNT_BURST = float(os.environ.get("ACCOUNT_BURST", 500))
+# the same for every subscription, so one noisy feed doesn't use up its account's budget
+SUBSCRIPTION_RATE = float(os.environ.get("SUBSCRIPTION_RATE", 10))
+SUBSCRIPTION_BURST = float(os.environ.get("SUBSCRIPTION_BURST", 100))
+# concurrent SSE streams of one account across all workers, 0 for no limit
+STREAMS_PER_ACCOUNT = int(os.environ.get("STREAMS_PER_ACCOUNT", 20))
+# requests one worker handles at a time before answering 503 right away, 0 for no limit
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", 500))
+# long-lived and operational paths never count against MAX_IN_FLIGHT
+UNLIMITED_PATHS = ("/v1/realtime/", "/v1/ready", "/v1/metrics")
+
+admission_rejected = metrics.Counter("admission_rejected_total", "Requests turned away by admission control", ("reason",))
+admission_in_flight = metrics.Gauge("admission_in_flight", "Requests being handled by this worker")
+
+
+class Rejected(HTTPException):
+    def __init__(self, status_code: int, reason: str, retry_after: float, detail: str):
+        admission_rejected.inc(reason=reason)
+        super().__init__(status_code=status_code, detail=detail, headers={"Retry-After": str(max(1, int(retry_after + 0.999)))})
+
+
+class Admission:
+    def __init__(self, path: str = ADMISSION_DB):
+        self.path = path
+        self.conn: sqlite3.Connection | None = None
+        # threadpool calls share the connection, one transaction at a time
+        self.lock = threading.Lock()
+        # pids repeat across container restarts, stream slots belong to this random id instead
+        self.worker: str | None = None
+        self.in_flight = 0
+
+    def connect(self) -> sqlite3.Connection:
+        # opened lazily, each forked worker gets its own connection to the same file
+        if self.conn is None:
+            conn = sqlite3.connect(self.path or ":memory:", timeout=1, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, pid INTEGER)")
+            # slots of the older pid-keyed layout can't be told apart, they are all dropped
+            if "pid" in [column[1] for column in conn.execute("PRAGMA table_info(streams)")]:
+                conn.execute("DROP TABLE streams")
+            conn.execute("CREATE TABLE IF NOT EXISTS streams (id INTEGER PRIMARY KEY, key TEXT, worker TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS streams_key ON streams (key)")
+            worker = secrets.token_hex(8)
+            conn.execute("INSERT INTO workers (id, pid) VALUES (?, ?)", (worker, os.getpid()))
+            self.conn, self.worker = conn, worker
+        return self.conn
+
+    async def run(self, fn, *args):
+        # sqlite blocks, so it runs off the event loop; a file locked past the timeout means a busy host, not a bug
+        try:
+            return await run_in_threadpool(fn, *args)
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Admission store is busy: {e}")
+            raise Rejected(503, "busy", 1, "Server is busy, try again") from e
+
+    def take(self, buckets: list[tuple[str, float, float, float]]) -> tuple[float, str | None]:
+        # (key, rate, burst, cost) buckets are charged together or not at all,
+        # a refusal names the bucket that is furthest behind and when it would fit
+        buckets = [bucket for bucket in buckets if bucket[1] > 0]
+        if not buckets:
+            return 0, None
+        with self.lock:
+            conn = self.connect()
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                levels = []
+                for key, rate, burst, cost in buckets:
+                    row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                    levels.append(burst if row is None else min(burst, row[0] + (now - row[1]) * rate))
+                wait, key = max(((cost - tokens) / rate, key) for tokens, (key, rate, _, cost) in zip(levels, buckets))
+                if wait <= 0:
+                    conn.executemany("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)",
+                                     [(key, tokens - cost, now) for tokens, (key, _, _, cost) in zip(levels, buckets)])
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return (wait, key) if wait > 0 else (0, None)
+
+    async def admit_publish(self, account_id: str, costs: dict[str, int]):
+        # costs: messages per subscription unique id; more than a full bucket would never fit, however long one waits
+        too_large = [(f"Account {account_id}", sum(costs.values()), ACCOUNT_RATE, ACCOUNT_BURST)] + \
+                    [(f"Subscription {unique_id}", cost, SUBSCRIPTION_RATE, SUBSCRIPTION_BURST) for unique_id, cost in costs.items()]
+        for name, cost, rate, burst in too_large:
+            if rate > 0 and cost > burst:
+                admission_rejected.inc(reason="too_large")
+                raise HTTPException(status_code=413, detail=f"{name} accepts at most {int(burst)} messages per request, got {cost}")
+        wait, key = await self.run(self.take, [(f"account:{account_id}", ACCOUNT_RATE, ACCOUNT_BURST, sum(costs.values()))] +
+                                   [(f"subscription:{unique_id}", SUBSCRIPTION_RATE, SUBSCRIPTION_BURST, cost)
+                                    for unique_id, cost in costs.items()])
+        if key is None:
+            return
+        kind, name = key.split(":", 1)
+        raise Rejected(429, f"{kind}_rate", wait, f"{kind.capitalize()} {name} publishes too fast")
+
+    async def open_stream(self, account_id: str) -> int | None:
+        if STREAMS_PER_ACCOUNT <= 0:
+            return None
+        stream_id = await self.run(self.claim_stream, account_id)
+        if stream_id is None:
+            raise Rejected(429, "streams", 5, f"Account {account_id} has too many open streams")
+        return stream_id
+
+    def claim_stream(self, account_id: str) -> int | None:
+        with self.lock:
+            conn = self.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                count = conn.execute("SELECT COUNT(*) FROM streams WHERE key = ?", (account_id,)).fetchone()[0]
+                stream_id = None
+                if count < STREAMS_PER_ACCOUNT:
+                    stream_id = conn.execute("INSERT INTO streams (key, worker) VALUES (?, ?)", (account_id, self.worker)).lastrowid
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return stream_id
+
+    async def close_stream(self, stream_id: int | None, attempts: int = 3):
+        if stream_id is None:
+            return
+        for attempt in range(attempts):
+            try:
+                return await run_in_threadpool(self.release_stream, stream_id)
+            except sqlite3.OperationalError as e:
+                # a slot kept here is only freed when this worker is replaced
+                logging.warning(f"Stream slot {stream_id} not released (attempt {attempt + 1}): {e}")
+
+    def release_stream(self, stream_id: int):
+        with self.lock:
+            self.connect().execute("DELETE FROM streams WHERE id = ?", (stream_id,))
+
+    def forget_dead_workers(self):
+        # streams of a killed worker were never closed, drop them at startup;
+        # a worker holding our own pid is an earlier incarnation from before a restart
+        try:
+            with self.lock:
+                self.forget_workers(self.connect())
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Streams of dead workers not cleaned up: {e}")
+
+    def forget_workers(self, conn: sqlite3.Connection):
+        for worker, pid in conn.execute("SELECT id, pid FROM workers WHERE id != ?", (self.worker,)).fetchall():
+            if pid != os.getpid():
+                try:
+                    os.kill(pid, 0)
+                    continue
+                except ProcessLookupError:
+                    pass
+                except PermissionError:
+                    continue
+            conn.execute("DELETE FROM streams WHERE worker = ?", (worker,))
+            conn.execute("DELETE FROM workers WHERE id = ?", (worker,))
+
+
+ADMISSION = Admission()
+
+
+# pure ASGI like MetricsMiddleware: sheds load before routing, body parsing or a database round trip
+class AdmissionMiddleware:
+    def __init__(self, app, admission: Admission = ADMISSION, limit: int = MAX_IN_FLIGHT):
+        self.app = app
+        self.admission = admission
+        self.limit = limit
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.limit or scope["path"].startswith(UNLIMITED_PATHS):
+            return await self.app(scope, receive, send)
+        if self.admission.in_flight >= self.limit:
+            admission_rejected.inc(reason="overloaded")
+            await send({"type": "http.response.start", "status": 503,
+                        "headers": [(b"content-type", b"application/json"), (b"retry-after", b"1")]})
+            return await send({"type": "http.response.body", "body": b'{"detail":"Server is overloaded"}'})
+        self.admission.in_flight += 1
+        admission_in_flight.set(self.admission.in_flight)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.admission.in_flight -= 1
+            admission_in_flight.set(self.admission.in_flight)
@@ -0,0 +1,48 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class TTLCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Any | None:
+        entry = self.data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.data[key]
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def peek(self, key: Hashable) -> Any | None:
+        entry = self.data.get(key)
+        return entry[1] if entry is not None else None
+
+    def set(self, key: Hashable, value: Any):
+        if value is None:
+            return
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def invalidate(self, *keys: Hashable):
+        for key in keys:
+            if self.data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self.data)
+        self.data.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self.data), "hits": self.hits, "misses": self.misses, "invalidations": self.invalidations}
@@ -1,13 +1,48 @@
+import abc
+import asyncio
+import concurrent.futures
+import importlib.util
 import json
 import os
+import random
+import time
+from typing import AsyncIterator, Iterable
 
 import httpx
 
+# httpx speaks HTTP/2 only with the optional h2 package (httpx[http2])
+HTTP2 = importlib.util.find_spec("h2") is not None
+
 URL = "https://onlynoise.rubedo.cloud/v1/" if os.environ.get("RELEASE") else "http://localhost:8080/v1/"
+# seconds to connect and to wait for an answer, realtime streams only use the first one
+CONNECT_TIMEOUT = float(os.environ.get("ONLY_CONNECT_TIMEOUT", 5))
+TIMEOUT = float(os.environ.get("ONLY_TIMEOUT", 30))
+# attempts after the first one, waits double from BACKOFF and are capped by MAX_BACKOFF (or the server's Retry-After)
+RETRIES = int(os.environ.get("ONLY_RETRIES", 3))
+BACKOFF = float(os.environ.get("ONLY_BACKOFF", 0.5))
+MAX_BACKOFF = float(os.environ.get("ONLY_MAX_BACKOFF", 30))
+# the server refused without doing anything, safe to send again even for a publish
+RETRY_STATUSES = (429, 503)
+# a gateway error may come after the publish went through, only reads are repeated on them
+GET_RETRY_STATUSES = (429, 502, 503, 504)
+# keep-alive connections kept by one pool
+MAX_CONNECTIONS = int(os.environ.get("ONLY_MAX_CONNECTIONS", 20))
+# messages per bulk publish request and requests sent at once; the server takes up to 500,
+# but no more than its SUBSCRIPTION_BURST (100 by default) for one subscription
+PUBLISH_BATCH = int(os.environ.get("ONLY_PUBLISH_BATCH", 100))
+PUBLISH_CONCURRENCY = int(os.environ.get("ONLY_PUBLISH_CONCURRENCY", 4))
+
 
+def client_options(timeout: float = TIMEOUT) -> dict:
+    return {
+        "http2": HTTP2,
+        "timeout": httpx.Timeout(timeout, connect=CONNECT_TIMEOUT),
+        "limits": httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS),
+        "follow_redirects": True,
+    }
 
-def request(method: str, appendix: str, **kwargs) -> dict:
-    res = httpx.request(method, URL + appendix, **kwargs, follow_redirects=True)
+
+def decode(res: httpx.Response) -> dict:
     if res.status_code > 399:
         try:
             js = res.json()
@@ -17,6 +52,74 @@ def request(method: str, appendix: str, **kwargs) -> dict:
     return res.json()
 
 
+def retry_delay(attempt: int, res: httpx.Response | None = None) -> float:
+    retry_after = res.headers.get("retry-after") if res is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), MAX_BACKOFF)
+    # full jitter, a crowd of publishers refused together doesn't come back together
+    return random.uniform(0, min(BACKOFF * 2 ** attempt, MAX_BACKOFF))
+
+
+def retryable(method: str, error: httpx.TransportError) -> bool:
+    # a request that never left is safe to repeat, a POST that may have been handled is not
+    return method == "GET" or isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout))
+
+
+def retry_status(method: str, res: httpx.Response) -> bool:
+    return res.status_code in (GET_RETRY_STATUSES if method == "GET" else RETRY_STATUSES)
+
+
+def batches(messages: Iterable[dict], size: int = PUBLISH_BATCH) -> Iterable[list[dict]]:
+    batch = []
+    for message in messages:
+        batch.append(message)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# one pool per process for the module level helpers, every OnlyClient shares it unless given its own
+_pool: httpx.Client | None = None
+
+
+def pool() -> httpx.Client:
+    global _pool
+    if _pool is None:
+        _pool = httpx.Client(**client_options())
+    return _pool
+
+
+def request(method: str, appendix: str, http: httpx.Client | None = None, **kwargs) -> dict:
+    http = http or pool()
+    for attempt in range(RETRIES + 1):
+        try:
+            res = http.request(method, URL + appendix, **kwargs)
+        except httpx.TransportError as e:
+            if attempt == RETRIES or not retryable(method, e):
+                raise
+            time.sleep(retry_delay(attempt))
+            continue
+        if not retry_status(method, res) or attempt == RETRIES:
+            return decode(res)
+        time.sleep(retry_delay(attempt, res))
+
+
+async def request_async(method: str, appendix: str, http: httpx.AsyncClient, **kwargs) -> dict:
+    for attempt in range(RETRIES + 1):
+        try:
+            res = await http.request(method, URL + appendix, **kwargs)
+        except httpx.TransportError as e:
+            if attempt == RETRIES or not retryable(method, e):
+                raise
+            await asyncio.sleep(retry_delay(attempt))
+            continue
+        if not retry_status(method, res) or attempt == RETRIES:
+            return decode(res)
+        await asyncio.sleep(retry_delay(attempt, res))
+
+
 def GET(appendix: str, **kwargs):
     return request(method="GET", appendix=appendix, **kwargs)
 
@@ -25,42 +128,47 @@ def POST(appendix: str, **kwargs):
     return request(method="POST", appendix=appendix, json=kwargs)
 
 
-class OnlyClient:
+# API calls shared by both clients: sync ones return the answer, async ones an awaitable of it
+class BaseClient(abc.ABC):
     def __init__(self, path=".client.json"):
         self.path = path
         self.config = {}
+        self.dirty = False
         self.load_config()
 
-    def create_account(self):
-        res = POST("accounts")
-        self.set("account_id", res["account_id"])
-        return self
+    @abc.abstractmethod
+    def request(self, method: str, appendix: str, **kwargs):
+        ...
 
     def get_account(self, account_id=None):
         if account_id is None:
             account_id = self.get("account_id")
-        req = GET(f"accounts/{account_id}")
-        return req
+        return self.request("GET", f"accounts/{account_id}")
 
     def create_subscription(self, unique_id, meta=None):
         account_id = self.get("account_id")
-        req = POST("subscriptions/", account_id=account_id, unique_id=unique_id, meta=meta if meta else {})
-        return req
+        return self.request("POST", "subscriptions/", json={"account_id": account_id, "unique_id": unique_id, "meta": meta if meta else {}})
 
     def subscribe_to(self, unique_id):
         account_id = self.get("account_id")
-        req = POST(f"accounts/{account_id}/subscriptions", unique_id=unique_id)
-        return req
+        return self.request("POST", f"accounts/{account_id}/subscriptions", json={"unique_id": unique_id})
 
     def publish_message(self, unique_id, **kwargs):
         account_id = self.get("account_id")
-        req = POST(f"accounts/{account_id}/subscriptions/{unique_id}", **kwargs)
-        return req
+        return self.request("POST", f"accounts/{account_id}/subscriptions/{unique_id}", json=kwargs)
 
-    def get_messages(self):
+    def publish_batch(self, messages: list[dict], unique_id=None):
+        # one request for up to 500 messages, each may name its own `unique_id`
         account_id = self.get("account_id")
-        req = GET(f"accounts/{account_id}/messages")
-        return req
+        return self.request("POST", f"accounts/{account_id}/publish", json={"unique_id": unique_id, "messages": messages})
+
+    def get_messages(self, **params):
+        account_id = self.get("account_id")
+        return self.request("GET", f"accounts/{account_id}/messages", params=params)
+
+    def get_summary(self):
+        account_id = self.get("account_id")
+        return self.request("GET", f"accounts/{account_id}/summary")
 
     def load_config(self):
         try:
@@ -68,19 +176,124 @@ class OnlyClient:
                 self.config = json.load(f)
         except FileNotFoundError:
             self.config = {}
+        self.dirty = False
         return self
 
     def get(self, key):
         return self.config.get(key)
 
     def set(self, key, value):
-        self.config[key] = value
-        if self.path != '-':
-            with open(self.path, 'w') as f:
+        # kept in memory, written by save() or when the client is closed
+        if self.config.get(key) != value:
+            self.config[key] = value
+            self.dirty = True
+        return self
+
+    def save(self):
+        if self.dirty and self.path != '-':
+            with open(f"{self.path}.tmp", 'w') as f:
                 json.dump(self.config, f)
+            os.replace(f"{self.path}.tmp", self.path)
+        self.dirty = False
         return self
 
 
+class OnlyClient(BaseClient):
+    def __init__(self, path=".client.json", http: httpx.Client | None = None):
+        super().__init__(path)
+        self.http = http or pool()
+
+    def request(self, method: str, appendix: str, **kwargs) -> dict:
+        return request(method, appendix, http=self.http, **kwargs)
+
+    def create_account(self):
+        res = self.request("POST", "accounts")
+        return self.set("account_id", res["account_id"]).save()
+
+    def publish_many(self, messages: Iterable[dict], unique_id=None, concurrency: int = PUBLISH_CONCURRENCY) -> list[dict]:
+        # bulk requests of PUBLISH_BATCH messages, `concurrency` of them in flight over the shared pool
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            return list(executor.map(lambda batch: self.publish_batch(batch, unique_id), batches(messages)))
+
+    def close(self):
+        self.save()
+        if self.http is not _pool:
+            self.http.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class AsyncOnlyClient(BaseClient):
+    def __init__(self, path=".client.json", http: httpx.AsyncClient | None = None):
+        super().__init__(path)
+        # an async pool belongs to the event loop it was created on, so each client owns one
+        self.http = http or httpx.AsyncClient(**client_options())
+
+    def request(self, method: str, appendix: str, **kwargs):
+        return request_async(method, appendix, self.http, **kwargs)
+
+    async def create_account(self):
+        res = await self.request("POST", "accounts")
+        return self.set("account_id", res["account_id"]).save()
+
+    async def publish_many(self, messages: Iterable[dict], unique_id=None, concurrency: int = PUBLISH_CONCURRENCY) -> list[dict]:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def publish(batch):
+            async with semaphore:
+                return await self.publish_batch(batch, unique_id)
+
+        return await asyncio.gather(*(publish(batch) for batch in batches(messages)))
+
+    async def stream_messages(self, account_id=None, last_event_id: str | None = None) -> AsyncIterator[dict]:
+        # realtime messages of the account, reconnecting with Last-Event-ID so nothing is missed in between
+        account_id = account_id or self.get("account_id")
+        attempt = 0
+        while True:
+            headers = {"Accept": "text/event-stream"}
+            if last_event_id is not None:
+                headers["Last-Event-ID"] = last_event_id
+            try:
+                async with self.http.stream("GET", URL + f"realtime/accounts/{account_id}/messages", headers=headers,
+                                            timeout=httpx.Timeout(None, connect=CONNECT_TIMEOUT)) as res:
+                    if res.status_code in GET_RETRY_STATUSES:
+                        await asyncio.sleep(retry_delay(attempt, res))
+                        attempt += 1
+                        continue
+                    res.raise_for_status()
+                    attempt = 0
+                    event_id, data = None, []
+                    async for line in res.aiter_lines():
+                        if line.startswith("id:"):
+                            event_id = line[3:].strip()
+                        elif line.startswith("data:"):
+                            data.append(line[5:].strip())
+                        elif not line and data:
+                            # opaque, the server packs what it still owes us into it
+                            if event_id:
+                                last_event_id = event_id
+                            yield json.loads("\n".join(data))
+                            event_id, data = None, []
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(retry_delay(attempt))
+            attempt = min(attempt + 1, RETRIES)
+
+    async def close(self):
+        self.save()
+        await self.http.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
 def main():
     from rich.console import Console
     console = Console()
@@ -1,3 +1,5 @@
+import time
+
 from onlyclient import OnlyClient
 from rich.console import Console
 
@@ -52,6 +54,7 @@ def create_channels():
     console.log(chan1.publish_message("rss", body="rss message"))
     console.log(chan2.publish_message("rss", body="rss message"))
     console.log(chan2.publish_message("rss2", body="2ss message"))
+    time.sleep(1)  # fan-out to subscribers happens after publish returns
 
     mess = clients[1].get_messages()["messages"]
     console.log(mess)
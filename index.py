@@ -1,12 +1,48 @@
-# from mongodb import DB
+import asyncio
+import contextlib
+
+import metrics
+from admission import ADMISSION, AdmissionMiddleware
+from mongodb import DB
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from routers import modules as router_modules
+from routers import fanout, realtime
 
 app = FastAPI()
 for module in router_modules:
     app.include_router(module.router, prefix="/v1")
 
+
+# fastapi 0.74 has no lifespan argument, the router takes it directly
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = False
+    DB.connect()
+    await DB.warm_up()
+    await DB.ensure_indexes()
+    DB.start_watching()
+    ADMISSION.forget_dead_workers()
+    fanout.pool.start()
+    metrics_dump = asyncio.create_task(metrics.dump_periodically())
+    app.state.ready = True
+    try:
+        yield
+    finally:
+        app.state.ready = False
+        await fanout.pool.stop()
+        metrics_dump.cancel()
+        if realtime.hub.task:
+            realtime.hub.task.cancel()
+        if DB.watcher:
+            DB.watcher.cancel()
+        DB.close()
+
+
+app.router.lifespan_context = lifespan
+# the last added middleware is the outermost: shed requests are still measured and get CORS headers
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -0,0 +1,73 @@
+import datetime
+import os
+import socket
+import time
+
+import pymongo
+import pymongo.errors
+from bson import ObjectId
+
+# a lease not renewed for this long is free to be taken over
+LEASE_TTL = int(os.environ.get("LEASE_TTL", 60))
+# finished leases are kept this long so late duplicates of the same work are still refused
+LEASE_KEEP = datetime.timedelta(days=1)
+
+
+def lease_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{ObjectId()}"
+
+
+# one document per unit of work, its _id is the work's id; the unique _id makes a claim atomic
+class Leases:
+    def __init__(self, collection, owner: str | None = None, ttl: int = LEASE_TTL):
+        self.collection = collection
+        self.owner = owner or lease_owner()
+        self.ttl = ttl
+
+    async def claim(self, ids: list) -> list:
+        if not ids:
+            return []
+        now = time.time()
+        taken = set()
+        try:
+            await self.collection.insert_many(
+                [{"_id": i, "owner": self.owner, "until": now + self.ttl, "done": False} for i in ids], ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            taken = {error["op"]["_id"] for error in e.details["writeErrors"] if error["code"] == 11000}
+        claimed = [i for i in ids if i not in taken]
+        if taken:
+            claimed += await self.take_over(list(taken), now)
+        return claimed
+
+    async def take_over(self, ids: list, now: float) -> list:
+        # leases of crashed owners, marked with a fresh claim id to learn which ones we won
+        claim = ObjectId()
+        await self.collection.update_many(
+            {"_id": {"$in": ids}, "done": False, "until": {"$lt": now}},
+            {"$set": {"owner": self.owner, "until": now + self.ttl, "claim": claim}})
+        return [lease["_id"] async for lease in self.collection.find({"_id": {"$in": ids}, "claim": claim}, {"_id": 1})]
+
+    async def expired(self, limit: int = 100) -> list:
+        cursor = self.collection.find({"done": False, "until": {"$lt": time.time()}}, {"_id": 1}).limit(limit)
+        return [lease["_id"] async for lease in cursor]
+
+    async def renew(self, ids: list):
+        if ids:
+            await self.collection.update_many(
+                {"_id": {"$in": ids}, "owner": self.owner, "done": False}, {"$set": {"until": time.time() + self.ttl}})
+
+    async def release(self, ids: list):
+        # expired rather than deleted: recover() only finds work through its lease, the tail has moved on
+        if ids:
+            await self.collection.update_many(
+                {"_id": {"$in": ids}, "owner": self.owner, "done": False}, {"$set": {"until": time.time()}})
+
+    async def complete(self, ids: list):
+        if ids:
+            await self.collection.update_many(
+                {"_id": {"$in": ids}, "owner": self.owner},
+                {"$set": {"done": True, "expires_at": datetime.datetime.utcnow() + LEASE_KEEP}})
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("done", pymongo.ASCENDING), ("until", pymongo.ASCENDING)])
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
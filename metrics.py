@@ -0,0 +1,201 @@
+import asyncio
+import json
+import math
+import os
+import time
+from contextlib import contextmanager
+
+# uvicorn runs several worker processes, each dumps its samples here and a scrape merges them all
+METRICS_DIR = os.environ.get("METRICS_DIR", "")
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+WIDTH_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values: dict[tuple, float] = {}
+        REGISTRY[name] = self
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> dict[str, float]:
+        return {render_sample(self.name, self.labelnames, key): value for key, value in self.values.items()}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, value: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        self.sums[key] = self.sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> dict[str, float]:
+        samples = {}
+        for key, counts in self.counts.items():
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                samples[render_sample(f"{self.name}_bucket", (*self.labelnames, "le"), (*key, le))] = count
+            samples[render_sample(f"{self.name}_sum", self.labelnames, key)] = self.sums[key]
+            samples[render_sample(f"{self.name}_count", self.labelnames, key)] = counts[-1]
+        return samples
+
+
+REGISTRY: dict[str, Metric] = {}
+
+
+def render_sample(name: str, labelnames: tuple, values: tuple) -> str:
+    if not labelnames:
+        return name
+    labels = ",".join(f'{label}="{value}"' for label, value in zip(labelnames, values))
+    return f"{name}{{{labels}}}"
+
+
+def snapshot() -> dict:
+    return {name: {"kind": metric.kind, "help": metric.help, "samples": metric.samples()} for name, metric in REGISTRY.items()}
+
+
+def dump():
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(f"{path}.tmp", path)
+
+
+def alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect() -> dict:
+    if not METRICS_DIR:
+        return snapshot()
+    dump()
+    merged = {}
+    for filename in os.listdir(METRICS_DIR):
+        if not filename.endswith(".json"):
+            continue
+        if not alive(int(filename[:-5])):
+            os.remove(os.path.join(METRICS_DIR, filename))
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, filename)) as f:
+                metrics = json.load(f)
+        except (OSError, ValueError):
+            continue
+        # every kind is additive across processes: counters, histogram buckets and gauges like open streams
+        for name, metric in metrics.items():
+            target = merged.setdefault(name, {**metric, "samples": {}})
+            for sample, value in metric["samples"].items():
+                target["samples"][sample] = target["samples"].get(sample, 0) + value
+    return merged
+
+
+def render() -> str:
+    lines = []
+    for name, metric in sorted(collect().items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        lines += [f"{sample} {value}" for sample, value in metric["samples"].items()]
+    return "\n".join(lines) + "\n"
+
+
+async def dump_periodically(interval: float = 5):
+    while METRICS_DIR:
+        dump()
+        await asyncio.sleep(interval)
+
+
+async def serve(port: int):
+    # minimal scrape endpoint for workers that have no HTTP server of their own
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        await reader.readuntil(b"\r\n\r\n")
+        body = render().encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n%s" % (len(body), body))
+        await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, "0.0.0.0", port)
+
+
+http_requests = Histogram("http_request_duration_seconds", "HTTP request latency", ("method", "handler", "status"))
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            endpoint = scope.get("endpoint")
+            # routers reuse function names (get_summary, mark_read...), the module tells them apart
+            handler = f"{endpoint.__module__}.{endpoint.__name__}" if endpoint else "unmatched"
+            http_requests.observe(time.perf_counter() - started, method=scope["method"], handler=handler, status=status)
@@ -1,12 +1,39 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import motor.motor_asyncio
 import pymongo
+import pymongo.errors
 import os
 
 import random
 import string
 import time
+import orjson
+from bson import ObjectId
 from fastapi import HTTPException
 
+from cache import TTLCache
+from leases import Leases
+
 MONGO_HOST = os.environ.get("MONGO", "localhost")
+CACHE_SIZE = int(os.environ.get("CACHE_SIZE", 10000))
+# upper bound of staleness when change streams are not available (standalone mongod)
+CACHE_TTL = float(os.environ.get("CACHE_TTL", 30))
+# connections per worker process: the pool never shrinks below MONGO_MIN_POOL, those are opened at startup
+MONGO_POOL_SIZE = int(os.environ.get("MONGO_POOL_SIZE", 100))
+MONGO_MIN_POOL = int(os.environ.get("MONGO_MIN_POOL", 10))
+# fail fast instead of hanging a request when mongod is away
+MONGO_TIMEOUT_MS = int(os.environ.get("MONGO_TIMEOUT_MS", 5000))
+# message contents are immutable, cached entries only leave to make room
+CONTENT_CACHE_SIZE = int(os.environ.get("CONTENT_CACHE_SIZE", 10000))
+# unused contents outlive the longest retention, referencing rows are gone by then
+CONTENT_TTL_DAYS = int(os.environ.get("CONTENT_TTL_DAYS", 400))
+# finished publish jobs stay readable through the jobs API this long
+JOBS_TTL_DAYS = int(os.environ.get("JOBS_TTL_DAYS", 7))
+# what a message row shares with every other copy of the same publish
+CONTENT_FIELDS = ("subject", "body", "url", "image_url")
 
 def create_random_string(length: int = 32) -> str:
     return "".join(
@@ -17,7 +44,11 @@ def create_random_string(length: int = 32) -> str:
 class MongoDB:
     def __init__(self, url: str = f"mongodb://{MONGO_HOST}:27017"):
         self.url = url
-        self.client: pymongo.MongoClient | None = None
+        self.client: motor.motor_asyncio.AsyncIOMotorClient | None = None
+        # routes and account documents, shared by requests, fan-out and push
+        self.cache = TTLCache(CACHE_SIZE, CACHE_TTL)
+        self.contents = TTLCache(CONTENT_CACHE_SIZE, float("inf"))
+        self.watcher: asyncio.Task | None = None
 
     def __enter__(self):
         if self.client is None:
@@ -28,57 +59,381 @@ class MongoDB:
         pass  # self.client.close()
 
     def connect(self):
-        self.client = pymongo.MongoClient(self.url)
+        self.client = motor.motor_asyncio.AsyncIOMotorClient(
+            self.url,
+            maxPoolSize=MONGO_POOL_SIZE,
+            minPoolSize=MONGO_MIN_POOL,
+            serverSelectionTimeoutMS=MONGO_TIMEOUT_MS,
+            connectTimeoutMS=MONGO_TIMEOUT_MS,
+        )
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    async def warm_up(self, connections: int = MONGO_MIN_POOL):
+        # concurrent pings check out that many pooled connections, so the first requests don't pay for the handshakes
+        with self:
+            await asyncio.gather(*(self.client.admin.command("ping") for _ in range(max(1, connections))))
+
+    async def status(self) -> dict:
+        started = time.perf_counter()
+        try:
+            with self:
+                await self.client.admin.command("ping")
+        except pymongo.errors.PyMongoError as e:
+            return {"ok": False, "error": str(e)}
+        return {"ok": True, "ping_ms": (time.perf_counter() - started) * 1000,
+                "pool": {"max": MONGO_POOL_SIZE, "min": MONGO_MIN_POOL}}
 
-    def accounts_get_by_filter(self, map_filter: dict, exception=None) -> dict:
+    async def accounts_get_by_filter(self, map_filter: dict, exception=None) -> dict:
         with self as db:
-            account = db.accounts.find_one(map_filter)
+            account = await db.accounts.find_one(map_filter)
             if not account:
                 raise HTTPException(status_code=400, detail=exception if exception else f"Account not found")
             return account
 
-    def accounts_create(self) -> dict:
+    async def accounts_create(self) -> dict:
         account_id = create_random_string()
         created_at = int(time.time())
 
         with self as db:
-            db.accounts.insert_one(
+            await db.accounts.insert_one(
                 {
                     "account_id": account_id,
                     "created_at": created_at,
-                    "devices": [],
                     "postboxes": [],
                     "subscriptions": []
                 }
             )
 
-            return db.accounts.find_one({"account_id": account_id})
+            return await db.accounts.find_one({"account_id": account_id})
+
+    async def accounts_get(self, account_id: str, exception: str | None = None, fresh: bool = False) -> dict:
+        # fresh skips the cache: without change streams another worker's write shows up only after CACHE_TTL,
+        # so whatever answers "not found" from a cached account has to look again first
+        oid = self.cache.peek(("oid", account_id))
+        account = self.cache.get(("account", oid)) if oid and not fresh else None
+        if account:
+            return account
+        account = await self.accounts_get_by_filter({"account_id": account_id}, exception)
+        self.cache.set(("oid", account_id), account["_id"])
+        self.cache.set(("account", account["_id"]), account)
+        return account
+
+    async def accounts_lookup(self, oid: ObjectId, fresh: bool = False) -> dict | None:
+        account = self.cache.get(("account", oid)) if not fresh else None
+        if account:
+            return account
+        with self as db:
+            account = await db.accounts.find_one({"_id": oid})
+        if account:
+            self.cache.set(("oid", account["account_id"]), oid)
+            self.cache.set(("account", oid), account)
+        return account
+
+    async def accounts_get_by_route(self, kind: str, key: str, exception: str | None = None, fresh: bool = False) -> dict:
+        route = await self.routes_get(kind, key)
+        account = await self.accounts_lookup(route["account"], fresh) if route else None
+        if not account:
+            raise HTTPException(status_code=400, detail=exception if exception else "Account not found")
+        return account
 
-    def accounts_get(self, account_id: str, exception: str | None = None) -> dict:
-        return self.accounts_get_by_filter({"account_id": account_id}, exception)
+    async def accounts_get_by_subscription(self, subscription_id: str, exception: str | None = None, fresh: bool = False) -> dict:
+        return await self.accounts_get_by_route("subscription", subscription_id, exception, fresh)
 
-    def accounts_get_by_subscription(self, subscription_id: str, exception: str | None = None) -> dict:
-        return self.accounts_get_by_filter({"subscriptions.subscription_id": subscription_id}, exception)
+    async def accounts_get_by_unique_id(self, unique_id: str, exception: str | None = None) -> dict:
+        return await self.accounts_get_by_route("unique", unique_id, exception)
 
-    def accounts_get_by_postbox(self, postbox_id: str, exception: str | None = None) -> dict:
-        return self.accounts_get_by_filter({"postboxes.postbox_id": postbox_id}, exception)
+    async def accounts_get_by_postbox(self, postbox_id: str, exception: str | None = None) -> dict:
+        return await self.accounts_get_by_route("postbox", postbox_id, exception)
 
-    def accounts_add_device(self, account_id: str, device_id: str):
+    # devices live in their own collection, unique per (account_id, device_id) and indexed by token
+    async def accounts_add_device(self, account_id: str, device_id: str):
         with self as db:
-            db.accounts.update_one(
-                {"account_id": account_id},
-                {"$push": {
-                    "devices": {
-                        "device_id": device_id, "created_at": int(time.time())
-                    }}
-                },
+            await db.devices.update_one(
+                {"account_id": account_id, "device_id": device_id},
+                {"$setOnInsert": {"token": device_id.split(":")[-1], "created_at": int(time.time())}},
+                upsert=True,
             )
 
-    def accounts_push_to(self, account_id: str | dict, selector: str, newdata: dict | str):
+    async def devices_list(self, account_id: str) -> list[dict]:
+        with self as db:
+            return await db.devices.find(
+                {"account_id": account_id}, {"_id": 0, "device_id": 1, "token": 1, "created_at": 1}
+            ).sort("created_at", pymongo.ASCENDING).to_list(None)
+
+    async def devices_prune(self, tokens: list[str]) -> int:
+        with self as db:
+            res = await db.devices.delete_many({"token": {"$in": tokens}})
+            return res.deleted_count
+
+    async def devices_rebuild(self):
+        with self as db:
+            async for account in db.accounts.find({"devices.0": {"$exists": True}}, {"account_id": 1, "devices": 1}):
+                for device in account["devices"]:
+                    await db.devices.update_one(
+                        {"account_id": account["account_id"], "device_id": device["device_id"]},
+                        {"$setOnInsert": {"token": device["device_id"].split(":")[-1], "created_at": device["created_at"]}},
+                        upsert=True,
+                    )
+
+    async def accounts_push_to(self, account_id: str | dict, selector: str, newdata: dict | str):
         with self as db:
-            db.accounts.update_one(
+            await db.accounts.update_one(
                 {"account_id": account_id} if type(account_id) == str else account_id,
                 {"$push": {selector: newdata}}
             )
+        self.forget_account(account_id)
+
+    async def accounts_set_retention(self, account: dict, days: int | None):
+        with self as db:
+            await db.accounts.update_one({"_id": account["_id"]}, {"$set": {"retention": days}})
+        self.forget_account(account)
+
+    def forget_account(self, account: str | dict):
+        # account_id, or a filter / document carrying the _id
+        oid = account.get("_id") if isinstance(account, dict) else self.cache.peek(("oid", account))
+        self.cache.invalidate(("account", oid))
+
+    # routes map postbox_id / subscription_id / unique_id to the owning account,
+    # so hot lookups are point reads instead of multikey scans over whole account documents
+    # route _id is "<kind>:<key>", so change stream events name the cache entry to drop
+    async def routes_get(self, kind: str, key: str) -> dict | None:
+        route = self.cache.get(("route", f"{kind}:{key}"))
+        if route:
+            return route
+        with self as db:
+            route = await db.routes.find_one({"_id": f"{kind}:{key}"})
+        self.cache.set(("route", f"{kind}:{key}"), route)
+        return route
+
+    async def routes_set(self, kind: str, key: str, account: dict, **fields):
+        with self as db:
+            await db.routes.update_one(
+                {"_id": f"{kind}:{key}"},
+                {"$set": {"kind": kind, "key": key, "account": account["_id"], "account_id": account["account_id"], **fields}},
+                upsert=True,
+            )
+        self.cache.invalidate(("route", f"{kind}:{key}"))
+
+    async def routes_delete(self, kind: str, key: str):
+        with self as db:
+            await db.routes.delete_one({"_id": f"{kind}:{key}"})
+        self.cache.invalidate(("route", f"{kind}:{key}"))
+
+    async def routes_rebuild(self):
+        with self as db:
+            async for account in db.accounts.find({}, {"account_id": 1, "postboxes": 1, "subscriptions": 1}):
+                for postbox in account.get("postboxes", []):
+                    await self.routes_set("postbox", postbox["postbox_id"], account,
+                                          subscription=postbox.get("subscription"), meta=postbox.get("meta", {}))
+                for subscription in account.get("subscriptions", []):
+                    await self.routes_set("subscription", subscription["subscription_id"], account, unique_id=subscription["unique_id"])
+                    await self.routes_set("unique", subscription["unique_id"], account, subscription_id=subscription["subscription_id"])
+
+    # monotonic per-account message numbers, a batch reserves its whole range with one $inc
+    async def sequence_reserve(self, account_id: str, count: int = 1) -> int:
+        with self as db:
+            counter = await db.counters.find_one_and_update(
+                {"_id": f"account:{account_id}"}, {"$inc": {"seq": count}},
+                upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        return counter["seq"] - count + 1
+
+    # content is stored once under its hash, message rows keep only the reference
+    async def contents_put(self, message: dict) -> str:
+        content = {k: message.get(k) for k in CONTENT_FIELDS}
+        content_id = hashlib.sha256(orjson.dumps(content, option=orjson.OPT_SORT_KEYS)).hexdigest()
+        with self as db:
+            await db.contents.update_one({"_id": content_id}, {"$setOnInsert": content,
+                                                               "$max": {"used_at": datetime.datetime.utcnow()}}, upsert=True)
+        self.contents.set(content_id, content)
+        return content_id
+
+    async def contents_join(self, messages: list[dict]) -> list[dict]:
+        # rows written before the content store carry their content inline and have no reference
+        ids = {message["content_id"] for message in messages if "content_id" in message}
+        contents = {content_id: self.contents.get(content_id) for content_id in ids}
+        missing = [content_id for content_id, content in contents.items() if content is None]
+        if missing:
+            with self as db:
+                async for content in db.contents.find({"_id": {"$in": missing}}, {"used_at": 0}):
+                    content_id = content.pop("_id")
+                    contents[content_id] = content
+                    self.contents.set(content_id, content)
+        for message in messages:
+            if "content_id" in message:
+                message.update(contents.get(message.pop("content_id")) or {k: "" for k in CONTENT_FIELDS})
+        return messages
+
+    # per-postbox counters kept next to the writes, `last` holds the newest message: $max compares its seq first
+    async def summaries_add(self, entries: list[dict]):
+        if not entries:
+            return
+        with self as db:
+            await db.summaries.bulk_write([pymongo.UpdateOne(
+                {"_id": entry["postbox_id"]},
+                {"$inc": {"total": entry["count"], "unread": entry["count"], "important_unread": entry["important"]},
+                 "$max": {"last": entry["last"]},
+                 "$setOnInsert": {"account_id": entry["account_id"]}},
+                upsert=True) for entry in entries], ordered=False)
+
+    async def summaries_list(self, account_id: str) -> list[dict]:
+        with self as db:
+            return await db.summaries.find({"account_id": account_id}).to_list(None)
+
+    async def summaries_read(self, postbox_id: str, attempts: int = 3):
+        # only what was there when reading started becomes read, a message landing meanwhile makes us retry
+        with self as db:
+            for _ in range(attempts):
+                summary = await db.summaries.find_one({"_id": postbox_id}, {"last.seq": 1})
+                if summary is None:
+                    return
+                res = await db.summaries.update_one(
+                    {"_id": postbox_id, "last.seq": summary.get("last", {}).get("seq")},
+                    {"$set": {"unread": 0, "important_unread": 0, "read_at": int(time.time())}})
+                if res.matched_count:
+                    return
+        raise HTTPException(status_code=409, detail=f"Postbox {postbox_id} is changing too fast, try again")
+
+    async def ensure_indexes(self):
+        with self as db:
+            await db.routes.create_index([("kind", pymongo.ASCENDING), ("key", pymongo.ASCENDING)], unique=True)
+            await db.routes.create_index("account")
+            await db.accounts.create_index("account_id", unique=True)
+            await db.devices.create_index([("account_id", pymongo.ASCENDING), ("device_id", pymongo.ASCENDING)], unique=True)
+            await db.devices.create_index("token")
+            await db.publish_jobs.create_index([("status", pymongo.ASCENDING), ("lease_until", pymongo.ASCENDING), ("created_at", pymongo.ASCENDING)])
+            await db.publish_jobs.create_index("account_id")
+            await db.publish_jobs.create_index("finished_at", expireAfterSeconds=JOBS_TTL_DAYS * 86400)
+            await db.messages.create_index("is_deleted", partialFilterExpression={"is_deleted": True})
+            # only unsent messages, what the push worker catches up on after a restart
+            await db.messages.create_index("created_at", partialFilterExpression={"is_sent": False})
+            # resumed realtime streams read exactly the messages after their Last-Event-ID
+            await db.messages.create_index([("account_id", pymongo.ASCENDING), ("seq", pymongo.ASCENDING)],
+                                           partialFilterExpression={"seq": {"$exists": True}})
+            await db.retention_runs.create_index("started_at")
+            await db.summaries.create_index("account_id")
+            await db.contents.create_index("used_at", expireAfterSeconds=CONTENT_TTL_DAYS * 86400)
+            await Leases(db.push_leases).ensure_indexes()
+            for owner in ("postbox_id", "account_id"):
+                await db.messages.create_index([(owner, pymongo.ASCENDING), ("is_deleted", pymongo.ASCENDING),
+                                                ("created_at", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+            if await db.routes.estimated_document_count() == 0 and await db.accounts.estimated_document_count() > 0:
+                await self.routes_rebuild()
+            if await db.devices.estimated_document_count() == 0 and await db.accounts.estimated_document_count() > 0:
+                await self.devices_rebuild()
+
+    async def postboxes_create(self, account: dict, postbox: dict):
+        await self.accounts_push_to({"_id": account["_id"]}, "postboxes", postbox)
+        await self.routes_set("postbox", postbox["postbox_id"], account,
+                              subscription=postbox.get("subscription"), meta=postbox.get("meta", {}))
+
+    async def postboxes_set_meta(self, account: dict, postbox_id: str, meta: dict):
+        with self as db:
+            await db.accounts.update_one(
+                {"_id": account["_id"], "postboxes.postbox_id": postbox_id},
+                {"$set": {"postboxes.$.meta": meta}}
+            )
+            await db.routes.update_one({"_id": f"postbox:{postbox_id}"}, {"$set": {"meta": meta}})
+        self.forget_account(account)
+        self.cache.invalidate(("route", f"postbox:{postbox_id}"))
+
+    async def postboxes_set_retention(self, account: dict, postbox_id: str, days: int | None):
+        with self as db:
+            await db.accounts.update_one(
+                {"_id": account["_id"], "postboxes.postbox_id": postbox_id},
+                {"$set": {"postboxes.$.retention": days}}
+            )
+        self.forget_account(account)
+
+    async def postboxes_delete(self, account: dict, postbox_id: str):
+        route = await self.routes_get("postbox", postbox_id)
+        with self as db:
+            await db.accounts.update_one(
+                {"_id": account["_id"]},
+                {"$pull": {"postboxes": {"postbox_id": postbox_id}}}
+            )
+        self.forget_account(account)
+        await self.routes_delete("postbox", postbox_id)
+        with self as db:
+            # tombstones, the retention worker reclaims them
+            await db.messages.update_many({"postbox_id": postbox_id}, {"$set": {"is_deleted": True}})
+            await db.summaries.delete_one({"_id": postbox_id})
+        unique_id = route.get("subscription") if route else None
+        owner = await self.routes_get("unique", unique_id) if unique_id else None
+        if owner:
+            with self as db:
+                await db.accounts.update_one(
+                    {"_id": owner["account"], "subscriptions.unique_id": unique_id},
+                    {"$pull": {"subscriptions.$.subscribers": postbox_id}}
+                )
+            self.forget_account({"_id": owner["account"]})
+
+    async def subscriptions_create(self, account: dict, subscription: dict):
+        await self.accounts_push_to({"_id": account["_id"]}, "subscriptions", subscription)
+        await self.routes_set("subscription", subscription["subscription_id"], account, unique_id=subscription["unique_id"])
+        await self.routes_set("unique", subscription["unique_id"], account, subscription_id=subscription["subscription_id"])
+
+    async def subscriptions_set(self, account: dict, subscription_id: str, fields: dict):
+        with self as db:
+            await db.accounts.update_one(
+                {"_id": account["_id"], "subscriptions.subscription_id": subscription_id},
+                {"$set": {f"subscriptions.$.{k}": v for k, v in fields.items()}}
+            )
+        # a stale updated_at is fine, keep hot publishers cached
+        if set(fields) != {"updated_at"}:
+            self.forget_account(account)
+
+    async def subscriptions_add_subscriber(self, unique_id: str, postbox_id: str):
+        owner = await self.routes_get("unique", unique_id)
+        await self.accounts_push_to({"_id": owner["account"], "subscriptions.unique_id": unique_id},
+                                    "subscriptions.$.subscribers", postbox_id)
+
+    async def subscriptions_get(self, oid: ObjectId, subscription_id: str) -> dict | None:
+        # read past the cache: fan-out must see a subscriber added by another worker a moment ago
+        with self as db:
+            account = await db.accounts.find_one({"_id": oid, "subscriptions.subscription_id": subscription_id},
+                                                 {"subscriptions": {"$elemMatch": {"subscription_id": subscription_id}}})
+        return account["subscriptions"][0] if account else None
+
+    def start_watching(self):
+        if self.watcher is None or self.watcher.done():
+            self.watcher = asyncio.create_task(self.watch())
+
+    async def watch(self):
+        # every process drops cache entries changed by any other process
+        pipeline = [{"$match": {"ns.coll": {"$in": ["accounts", "routes"]}}}]
+        while True:
+            try:
+                with self as db:
+                    async with db.watch(pipeline) as stream:
+                        # whatever changed while we were not listening
+                        self.cache.clear()
+                        async for change in stream:
+                            self.invalidate_change(change)
+            except pymongo.errors.OperationFailure as e:
+                logging.warning(f"Change streams are not available, cache entries live for {CACHE_TTL}s: {e}")
+                return
+            except pymongo.errors.PyMongoError as e:
+                logging.error(f"Cache invalidation stream failed: {e!r}")
+                await asyncio.sleep(1)
+
+    def invalidate_change(self, change: dict):
+        if change["operationType"] in ("drop", "rename", "dropDatabase", "invalidate"):
+            return self.cache.clear()
+        oid = change["documentKey"]["_id"]
+        if change["ns"]["coll"] == "routes":
+            return self.cache.invalidate(("route", oid))
+        update = change.get("updateDescription", {})
+        if not update.get("removedFields") and update.get("updatedFields") \
+                and all(field.endswith(".updated_at") for field in update["updatedFields"]):
+            return
+        self.cache.invalidate(("account", oid))
+
+    def cache_stats(self) -> dict:
+        return {**self.cache.stats(), "watching": self.watcher is not None and not self.watcher.done()}
+
 
 DB = MongoDB()
@@ -1,46 +1,81 @@
+import asyncio
 import logging
 import os
-import tempfile
 import time
+import zlib
 
+import motor.motor_asyncio
 import pymongo
-from pyapns_client import APNSClient, APNSDeviceException, APNSProgrammingException, APNSServerException, IOSNotification, IOSPayload, IOSPayloadAlert, \
-    UnregisteredException
-import pymongo.database
-from mongodb import DB, MongoDB
+from aioapns import APNs, NotificationRequest
+from aioapns.common import PRIORITY_HIGH, PRIORITY_NORMAL, NotificationResult
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+import metrics
+from leases import LEASE_TTL, Leases
+from mongodb import DB
 
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-class DopplerFile:
-    def __enter__(self):
-        self.file = tempfile.NamedTemporaryFile()
-        self.file.write(os.environ["APPLE_AUTH_KEY"].encode("utf-8"))
-        self.file.seek(0)
-        return self.file.name
+APNS_TOPIC = "com.isnifer.balalaika"
+# every connection is a single HTTP/2 session multiplexing up to 1000 streams, so a few are plenty
+APNS_CONNECTIONS = int(os.environ.get("APNS_CONNECTIONS", 4))
+# how many device pushes (and messages) of bulk traffic may be in flight at once
+APNS_CONCURRENCY = int(os.environ.get("APNS_CONCURRENCY", 200))
+# the same for important messages, a budget of their own that bulk traffic can't use up
+IMPORTANT_CONCURRENCY = int(os.environ.get("IMPORTANT_CONCURRENCY", 50))
+# bulk messages started per second, 0 for no limit
+BULK_RATE = float(os.environ.get("BULK_RATE", 0))
+# APNs reasons meaning the token will never work again
+DEVICE_GONE = {"Unregistered", "BadDeviceToken", "DeviceTokenNotForTopic"}
+# dead tokens are collected and removed in one bulk delete every this many seconds
+PRUNE_INTERVAL = int(os.environ.get("PRUNE_INTERVAL", 10))
+# messages claimed with one lease write
+CLAIM_BATCH = int(os.environ.get("CLAIM_BATCH", 100))
+# seconds to wait before claiming again after a failed lease write
+CLAIM_BACKOFF = float(os.environ.get("CLAIM_BACKOFF", 1))
+# finished messages are marked sent in bulk every this many seconds
+COMPLETE_INTERVAL = float(os.environ.get("COMPLETE_INTERVAL", 0.5))
+# optional split of postboxes between replicas: this replica handles crc32(postbox_id) % PUSH_SHARDS == PUSH_SHARD
+PUSH_SHARDS = int(os.environ.get("PUSH_SHARDS", 1))
+PUSH_SHARD = int(os.environ.get("PUSH_SHARD", 0))
+# the position in the message stream is saved every this many seconds
+CHECKPOINT_INTERVAL = float(os.environ.get("CHECKPOINT_INTERVAL", 5))
+# resume a bit before the checkpoint, inserts from several API workers are not strictly ordered
+CHECKPOINT_SLACK = int(os.environ.get("CHECKPOINT_SLACK", 5))
+# backlog read per round trip while catching up after a restart
+CATCHUP_BATCH = int(os.environ.get("CATCHUP_BATCH", 1000))
+# a postbox's first message is pushed at once, the rest of a burst is merged into one push per window (0 disables)
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", 5))
+# a window holding this many messages is pushed without waiting for it to end
+COALESCE_MAX = int(os.environ.get("COALESCE_MAX", 100))
+# Prometheus scrape port of this worker
+PUSH_METRICS_PORT = int(os.environ.get("PUSH_METRICS_PORT", 9100))
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.file.close()
+push_seconds = metrics.Histogram("push_send_seconds", "APNs round trip of one device push", ("lane",))
+push_results = metrics.Counter("push_results_total", "Device pushes by APNs outcome", ("result",))
+push_coalesced = metrics.Counter("push_coalesced_total", "Messages merged into another message's push")
+message_seconds = metrics.Histogram("push_message_seconds", "Time to push one message to all devices of its account", ("lane",))
+push_delay_seconds = metrics.Histogram("push_delay_seconds", "Time from storing a message to its push", ("lane",),
+                                       buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+push_backlog = metrics.Gauge("push_backlog", "Messages waiting in the worker", ("lane", "stage"))
 
 
-def create_client(key_file: str):
-    return APNSClient(
-        mode=APNSClient.MODE_PROD,  # if os.environ.get('DOPPLER_ENVIRONMENT') == 'prod' else APNSClient.MODE_DEV,
-        root_cert_path=None,  # '/path/to/root_cert.pem',
-        auth_key_path=key_file,
-        auth_key_id=os.environ["APPLE_KEY_ID"],
-        team_id=os.environ["APPLE_TEAM_ID"])
+def create_client() -> APNs:
+    # aioapns keeps the pool of connections open and reuses the signed JWT until it has to be refreshed
+    return APNs(
+        key=os.environ["APPLE_AUTH_KEY"],
+        key_id=os.environ["APPLE_KEY_ID"],
+        team_id=os.environ["APPLE_TEAM_ID"],
+        topic=APNS_TOPIC,
+        max_connections=APNS_CONNECTIONS,
+        use_sandbox=False,  # os.environ.get('DOPPLER_ENVIRONMENT') != 'prod'
+    )
 
 
-def drop_device_from_accounts(db: pymongo.database.Database, device_id: str):
-    db.accounts.update_many({}, {'$pull': {'devices': {'device_id': device_id}}})
-    logging.info(f"Device {device_id} removed from all accounts")
+def in_shard(postbox_id: str, shards: int = PUSH_SHARDS, shard: int = PUSH_SHARD) -> bool:
+    return shards <= 1 or zlib.crc32(postbox_id.encode()) % shards == shard
 
 
-def send_message(db: pymongo.database.Database, message: dict, client: APNSClient):
-    account = db.accounts.find_one({'postboxes.postbox_id': message['postbox_id']})
-    if not account:
-        return logging.error(f"No devices found for postbox {message['postbox_id']} {message=}")
+def create_payload(message: dict, count: int = 1, thread_id: str | None = None) -> dict:
     alert = {}
     if "meta" in message and "sender" in message["meta"]:
         alert["title"] = message["meta"]["sender"]
@@ -50,49 +85,370 @@ def send_message(db: pymongo.database.Database, message: dict, client: APNSClien
     else:
         alert["title"] = message.get("subject", None)
         alert["body"] = message.get("body", None)
+    if count > 1:
+        # a merged burst shows its newest message
+        alert["subtitle"] = f"{count} new messages"
+    aps = {"alert": {k: v for k, v in alert.items() if v is not None}}
+    if thread_id:
+        aps["thread-id"] = thread_id
+    return {"aps": aps}
+
+
+# important and bulk messages are queued, claimed and pushed separately, each with its own budget
+class Lane:
+    def __init__(self, name: str, concurrency: int, priority: int, rate: float = 0):
+        self.name = name
+        self.priority = priority
+        self.rate = rate
+        self.queue: asyncio.Queue = asyncio.Queue(CLAIM_BATCH * 10)
+        self.pushes = asyncio.Semaphore(concurrency)
+        self.messages = asyncio.Semaphore(concurrency)
+        # fed and not yet claimed, the checkpoint can't pass these
+        self.pending = 0
+        self.in_flight = 0
+
+    def busy(self) -> bool:
+        return self.pending > 0 or self.messages.locked()
+
+
+# messages of one postbox waiting for the end of its coalescing window, the window task owns them until they are pushed
+class Window:
+    def __init__(self):
+        self.pending: list[dict] = []
+        self.full = asyncio.Event()
+
+
+# last created_at handed to the claimer, shared by all replicas of a shard; leases dedupe the overlap
+class Checkpoint:
+    def __init__(self, collection, name: str = f"push-{PUSH_SHARD}-of-{PUSH_SHARDS}"):
+        self.collection = collection
+        self.name = name
+        self.created_at = 0
+        self.saved = 0
+
+    async def load(self) -> int:
+        doc = await self.collection.find_one({'_id': self.name})
+        self.created_at = self.saved = doc['created_at'] if doc else 0
+        return self.resume_from()
+
+    def resume_from(self) -> int:
+        return max(0, self.created_at - CHECKPOINT_SLACK)
+
+    def advance(self, message: dict):
+        self.created_at = max(self.created_at, message['created_at'])
 
-    payload = IOSPayload(alert=IOSPayloadAlert(**alert))
-    notification = IOSNotification(payload=payload, topic='com.isnifer.balalaika')
+    async def save(self):
+        if self.created_at <= self.saved:
+            return
+        created_at = self.created_at
+        await self.collection.update_one(
+            {'_id': self.name}, {'$max': {'created_at': created_at}, '$set': {'updated_at': time.time()}}, upsert=True)
+        self.saved = created_at
 
-    for device in account['devices']:
-        logging.info(f"Sending message {message=} to device {device=}")
-        device_token = device['device_id'].split(':')[-1] if ":" in device['device_id'] else device['device_id']
+
+class Dispatcher:
+    def __init__(self, db: motor.motor_asyncio.AsyncIOMotorDatabase, client: APNs, concurrency: int = APNS_CONCURRENCY,
+                 window: float = COALESCE_WINDOW):
+        self.db = db
+        self.client = client
+        self.window = window
+        self.windows: dict[str, Window] = {}
+        self.leases = Leases(db.push_leases)
+        self.checkpoint = Checkpoint(db.checkpoints)
+        self.important = Lane("important", IMPORTANT_CONCURRENCY, PRIORITY_HIGH)
+        self.bulk = Lane("bulk", concurrency, PRIORITY_NORMAL, BULK_RATE)
+        self.in_flight: dict = {}
+        # held in a coalescing window, their dispatch slot is already free
+        self.held: set = set()
+        # leased by the claim loop and waiting for their turn (rate limit, important traffic, a free slot)
+        self.claimed: set = set()
+        self.completed: list = []
+        self.gone: set[str] = set()
+        self.tasks: list[asyncio.Task] = []
+
+    def lane(self, message: dict) -> Lane:
+        return self.important if message.get('important') else self.bulk
+
+    def owned(self, message_id) -> bool:
+        return message_id in self.in_flight or message_id in self.held or message_id in self.claimed
+
+    def leased(self) -> list:
+        return list(self.in_flight) + list(self.held) + list(self.claimed)
+
+    async def push(self, lane: Lane, token: str, payload: dict, collapse_key: str | None = None) -> NotificationResult | None:
+        async with lane.pushes:
+            try:
+                with push_seconds.time(lane=lane.name):
+                    result = await self.client.send_notification(NotificationRequest(
+                        device_token=token, message=payload, collapse_key=collapse_key, priority=lane.priority))
+            except Exception as e:
+                push_results.inc(result=type(e).__name__)
+                logging.error(f"Unknown error sending to {token}: {e!r}")
+                return None
+            push_results.inc(result="success" if result.is_successful else result.description)
+            return result
+
+    async def send_message(self, message: dict) -> bool:
+        # True when the message went into a coalescing window, its push and completion happen there
+        lane = self.lane(message)
+        with message_seconds.time(lane=lane.name):
+            held = await self.coalesce(message)
+        if not held:
+            push_delay_seconds.observe(time.time() - message['created_at'], lane=lane.name)
+        return held
+
+    async def coalesce(self, message: dict) -> bool:
+        postbox_id = message['postbox_id']
+        # important messages are never held back
+        if self.window <= 0 or message.get('important'):
+            await self.send_to_devices([message])
+            return False
+        window = self.windows.get(postbox_id)
+        if window is None:
+            self.open_window(postbox_id)
+            await self.send_to_devices([message])
+            return False
+        window.pending.append(message)
+        self.held.add(message['_id'])
+        if len(window.pending) >= COALESCE_MAX:
+            window.full.set()
+            self.open_window(postbox_id)
+        return True
+
+    def open_window(self, postbox_id: str):
+        window = self.windows[postbox_id] = Window()
+        self.tasks.append(asyncio.create_task(self.hold(postbox_id, window)))
+
+    async def hold(self, postbox_id: str, window: Window):
         try:
-            client.push(notification=notification, device_token=device_token)
-        except UnregisteredException:
-            logging.error(f"Device {device_token} not registered")
-            drop_device_from_accounts(db, device_token)
-        except APNSDeviceException as e:
-            logging.error(f"Device {device_token} error {e.args}")
-            drop_device_from_accounts(db, device_token)
-        except APNSServerException as e:
-            logging.error(f"Server error {e.args}")
-        except APNSProgrammingException as e:
-            logging.error(f"Programming error {e.args}")
-        except Exception as e:
-            logging.error(f"Unknown error {e.args}")
+            try:
+                await asyncio.wait_for(window.full.wait(), self.window)
+            except asyncio.TimeoutError:
+                pass
+            if self.windows.get(postbox_id) is window:
+                if window.pending:
+                    # a burst that goes on keeps getting one push per window
+                    self.open_window(postbox_id)
+                else:
+                    del self.windows[postbox_id]
+            if not window.pending:
+                return
+            push_coalesced.inc(len(window.pending) - 1)
+            ids = [message['_id'] for message in window.pending]
+            try:
+                await self.send_to_devices(window.pending)
+            except Exception as e:
+                logging.error(f"Coalesced push of {len(ids)} messages failed: {e!r}")
+                # let any replica retry them right away
+                await self.leases.release(ids)
+            else:
+                self.completed += ids
+                for message in window.pending:
+                    push_delay_seconds.observe(time.time() - message['created_at'], lane=self.bulk.name)
+            finally:
+                self.held.difference_update(ids)
         finally:
-            logging.info(f"Message sent to device {device_token=}")
-    db.messages.update_one({'_id': message['_id']}, {'$set': {'is_sent': True}})
+            self.tasks.remove(asyncio.current_task())
 
+    async def send_to_devices(self, messages: list[dict]):
+        message = (await DB.contents_join([dict(messages[-1])]))[0]
+        route = await DB.routes_get('postbox', message['postbox_id'])
+        if not route:
+            return logging.error(f"No devices found for postbox {message['postbox_id']} {message=}")
+        # collapse-id lets a newer push of the postbox replace an older one still on the device
+        payload = create_payload(message, len(messages), route.get('subscription') or message['postbox_id'])
+        devices = [device for device in await DB.devices_list(route['account_id']) if device['token'] not in self.gone]
+        lane = self.lane(message)
+        results = await asyncio.gather(*(self.push(lane, device['token'], payload, message['postbox_id']) for device in devices))
+        for device, result in zip(devices, results):
+            if result is None or result.is_successful:
+                continue
+            if result.description in DEVICE_GONE:
+                logging.error(f"Device {device['device_id']} not registered ({result.description})")
+                self.gone.add(device['token'])
+            else:
+                logging.error(f"Device {device['device_id']} error {result.status} {result.description}")
+        logging.info(f"Message {message['_id']} (of {len(messages)}) sent to {len(devices)} devices")
 
-def main():
-    logging.info("Starting")
-    with DopplerFile() as key_file:
-        client = create_client(key_file)
-        logging.info("Created client")
+    async def feed(self, message: dict):
+        # the tail is reopened from the start of the backlog, don't send what is already on its way
+        if self.owned(message['_id']) or not in_shard(message['postbox_id']):
+            return
+        lane = self.lane(message)
+        lane.pending += 1
+        await lane.queue.put(message)
+
+    async def claim(self, lane: Lane):
         while True:
-            with DB as db:
-                logging.info("DB finding")
-                cursor = db.messages.find({'is_sent': False, 'is_deleted': False},
-                                          cursor_type=pymongo.CursorType.TAILABLE_AWAIT).limit(1)
-                logging.info("messages found")
+            batch = [await lane.queue.get()]
+            while len(batch) < CLAIM_BATCH and not lane.queue.empty():
+                batch.append(lane.queue.get_nowait())
+            fed = len(batch)
+            batch = [message for message in batch if not self.owned(message['_id'])]
+            claimed = set(await self.claim_leases([message['_id'] for message in batch]))
+            # renewed like the in-flight ones while they wait, an expired lease would be recovered and pushed twice
+            self.claimed.update(claimed)
+            for message in batch:
+                if message['_id'] in claimed:
+                    if lane is self.bulk:
+                        await self.defer()
+                    await self.dispatch(message)
+                # leased by us or by another replica, either way it is durable past this point;
+                # important messages overtake bulk ones, so they only move the checkpoint when no bulk message waits
+                if lane is self.bulk or self.bulk.pending == 0:
+                    self.checkpoint.advance(message)
+            lane.pending -= fed
+
+    async def claim_leases(self, ids: list) -> list:
+        # the batch is already off the queue, so it is retried rather than dropped;
+        # leases a failed attempt did write come back through recover() once they expire
+        while True:
+            try:
+                return await self.leases.claim(ids)
+            except Exception as e:
+                logging.error(f"Claiming {len(ids)} messages failed: {e!r}")
+                await asyncio.sleep(CLAIM_BACKOFF)
+
+    async def defer(self):
+        # bulk traffic waits while important messages are queued or use their whole budget
+        while self.important.busy():
+            await asyncio.sleep(0.01)
+        if self.bulk.rate > 0:
+            await asyncio.sleep(1 / self.bulk.rate)
+
+    async def dispatch(self, message: dict):
+        lane = self.lane(message)
+        await lane.messages.acquire()
+        # recover and the claim loop may both get here for the same message
+        if message['_id'] in self.in_flight or message['_id'] in self.held:
+            return lane.messages.release()
+        self.claimed.discard(message['_id'])
+        lane.in_flight += 1
+        task = asyncio.create_task(self.send_message(message))
+        self.in_flight[message['_id']] = task
+        task.add_done_callback(lambda t: self.done(message['_id'], lane, t))
+
+    def done(self, message_id, lane: Lane, task: asyncio.Task):
+        self.in_flight.pop(message_id, None)
+        lane.in_flight -= 1
+        lane.messages.release()
+        if not task.cancelled() and task.exception():
+            logging.error(f"Message {message_id} failed: {task.exception()!r}")
+            # let any replica retry it right away
+            asyncio.create_task(self.leases.release([message_id]))
+        elif task.cancelled() or not task.result():
+            self.completed.append(message_id)
+
+    async def complete(self):
+        while True:
+            await asyncio.sleep(COMPLETE_INTERVAL)
+            for lane in (self.important, self.bulk):
+                push_backlog.set(lane.pending, lane=lane.name, stage="queued")
+                push_backlog.set(lane.in_flight, lane=lane.name, stage="in_flight")
+            push_backlog.set(len(self.held), lane=self.bulk.name, stage="held")
+            if not self.completed:
+                continue
+            ids, self.completed = self.completed, []
+            try:
+                await self.db.messages.update_many({'_id': {'$in': ids}}, {'$set': {'is_sent': True}})
+                await self.leases.complete(ids)
+            except Exception as e:
+                logging.error(f"Completing {len(ids)} messages failed: {e!r}")
+                self.completed += ids
+
+    async def renew(self):
+        while True:
+            await asyncio.sleep(LEASE_TTL / 3)
+            try:
+                await self.leases.renew(self.leased())
+            except Exception as e:
+                logging.error(f"Lease renewal failed: {e!r}")
+
+    async def recover(self):
+        # work of crashed replicas comes back once its lease expires
+        while True:
+            await asyncio.sleep(LEASE_TTL / 2)
+            try:
+                ids = await self.leases.expired(CLAIM_BATCH)
+                claimed = set(await self.leases.claim(ids))
+                async for message in self.db.messages.find({'_id': {'$in': list(claimed)}}):
+                    claimed.discard(message['_id'])
+                    if message['is_sent'] or message['is_deleted']:
+                        self.completed.append(message['_id'])
+                    elif not self.owned(message['_id']):
+                        logging.info(f"Recovered message {message['_id']} from an expired lease")
+                        await self.dispatch(message)
+                # whatever is left was overwritten in the capped collection
+                self.completed += list(claimed)
+            except Exception as e:
+                logging.error(f"Lease recovery failed: {e!r}")
+
+    async def save_checkpoint(self):
+        while True:
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            try:
+                await self.checkpoint.save()
+            except Exception as e:
+                logging.error(f"Saving checkpoint failed: {e!r}")
+
+    async def prune(self):
+        while True:
+            await asyncio.sleep(PRUNE_INTERVAL)
+            if not self.gone:
+                continue
+            tokens, self.gone = list(self.gone), set()
+            try:
+                removed = await DB.devices_prune(tokens)
+                logging.info(f"Pruned {removed} devices for {len(tokens)} dead tokens")
+            except Exception as e:
+                logging.error(f"Device pruning failed: {e!r}")
+                self.gone.update(tokens)
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.claim(lane)) for lane in (self.important, self.bulk)]
+        self.tasks += [asyncio.create_task(loop()) for loop in (self.complete, self.renew, self.recover, self.save_checkpoint, self.prune)]
+
+    async def stop(self):
+        await self.leases.release(self.leased())
+        await self.checkpoint.save()
+        for task in self.tasks:
+            task.cancel()
+
+
+async def main():
+    logging.info("Starting")
+    client = create_client()
+    logging.info("Created client")
+    await DB.ensure_indexes()
+    DB.start_watching()
+    await metrics.serve(PUSH_METRICS_PORT)
+    with DB as db:
+        dispatcher = Dispatcher(db, client)
+        dispatcher.start()
+        try:
+            # drain the backlog through the index of unsent messages, important ones first, then follow the live tail
+            start = await dispatcher.checkpoint.load()
+            logging.info(f"Catching up from {start}")
+            for lane in ({'important': True}, {}):
+                cursor = db.messages.find({'is_sent': False, 'is_deleted': False, 'created_at': {'$gte': start}, **lane}) \
+                    .sort('created_at', pymongo.ASCENDING).batch_size(CATCHUP_BATCH)
+                async for message in cursor:
+                    await dispatcher.feed(message)
+            logging.info("Caught up, tailing")
+            # a tailable cursor can't use an index or start at a position, so every (re)open scans the capped
+            # collection from its oldest document; the filter only limits what is returned, the cost is bounded
+            # by the collection's cap rather than by the checkpoint. Reopens are rare, the open cursor is cheap.
+            while True:
+                cursor = db.messages.find({'is_sent': False, 'is_deleted': False,
+                                           'created_at': {'$gte': dispatcher.checkpoint.resume_from()}},
+                                          cursor_type=pymongo.CursorType.TAILABLE_AWAIT)
                 while cursor.alive:
-                    for message in cursor:
-                        logging.info(f"message found {message=}")
-                        send_message(db, message, client)
-                        time.sleep(1)
+                    async for message in cursor:
+                        await dispatcher.feed(message)
+                await asyncio.sleep(1)
+        finally:
+            await dispatcher.stop()
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import os
+import time
+
+import pymongo
+import pymongo.errors
+
+from mongodb import DB
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+# used when neither the postbox nor its account sets `retention` (days)
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", 7))
+# messages removed per delete, small enough to never hold the collection for long
+RETENTION_BATCH = int(os.environ.get("RETENTION_BATCH", 500))
+# pause between batches, leaves room for foreground traffic
+RETENTION_PACE = float(os.environ.get("RETENTION_PACE", 0.2))
+# pause between full passes
+RETENTION_INTERVAL = int(os.environ.get("RETENTION_INTERVAL", 15 * 60))
+
+
+class Retention:
+    def __init__(self, db, batch: int = RETENTION_BATCH, pace: float = RETENTION_PACE):
+        self.db = db
+        self.batch = batch
+        self.pace = pace
+
+    async def purge(self, query: dict) -> int:
+        purged = 0
+        while True:
+            ids = [m["_id"] async for m in self.db.messages.find(query, {"_id": 1}).limit(self.batch)]
+            if not ids:
+                return purged
+            res = await self.db.messages.delete_many({"_id": {"$in": ids}})
+            purged += res.deleted_count
+            await asyncio.sleep(self.pace)
+            if len(ids) < self.batch:
+                return purged
+
+    async def run_once(self) -> dict:
+        started_at = time.time()
+        stats = await self.db.command("collStats", "messages")
+        avg_size = stats.get("avgObjSize", 0)
+        tombstones = await self.purge({"is_deleted": True})
+        expired = 0
+        async for account in self.db.accounts.find({}, {"retention": 1, "postboxes.postbox_id": 1, "postboxes.retention": 1}):
+            for postbox in account.get("postboxes", []):
+                days = postbox.get("retention") or account.get("retention") or RETENTION_DAYS
+                expired += await self.purge({
+                    "postbox_id": postbox["postbox_id"],
+                    "is_deleted": False,
+                    "created_at": {"$lt": int(started_at) - days * 24 * 60 * 60},
+                })
+        run = {
+            "started_at": started_at,
+            "finished_at": time.time(),
+            "tombstones": tombstones,
+            "expired": expired,
+            "bytes": int((tombstones + expired) * avg_size),
+        }
+        await self.db.retention_runs.insert_one(dict(run))
+        logging.info(f"Retention pass removed {tombstones} deleted and {expired} expired messages, ~{run['bytes']} bytes")
+        return run
+
+
+async def main():
+    logging.info("Starting")
+    with DB as db:
+        retention = Retention(db)
+        while True:
+            try:
+                await retention.run_once()
+            except pymongo.errors.OperationFailure as e:
+                # capped collections only accept deletes on MongoDB 5.0+
+                logging.error(f"Retention pass failed: {e}")
+            await asyncio.sleep(RETENTION_INTERVAL)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,11 +1,16 @@
+import collections
 import time
-from typing import List
-from fastapi import APIRouter, HTTPException, Response
+from typing import Dict, List
+from fastapi import APIRouter, HTTPException, Query, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 
+from bson import ObjectId
+from bson.errors import InvalidId
+from admission import ADMISSION
 from mongodb import DB
-from . import postbox
-from .meta import IncomingMessage, Meta, create_random_string, put_message_to_subscription, efl
+from . import fanout, postbox
+from .meta import MESSAGES_LIMIT, MESSAGES_MAX_LIMIT, PUBLISH_MAX_BATCH, IncomingMessage, Meta, PostboxSummary, RetentionRequest, create_random_string, efl, find_messages, postbox_summary, stream_messages
 
 router = APIRouter(prefix="/accounts")
 
@@ -55,81 +60,199 @@ class CreateSubscriptionRequest(BaseModel):
     meta: Meta | None = Field(None, title="Meta data")
 
 
+class PublishResponse(BaseModel):
+    job_id: str = Field(..., title="Publish job ID")
+
+
+class BatchMessage(IncomingMessage):
+    unique_id: str | None = Field(None, title="Subscription unique ID, the batch `unique_id` if not set")
+
+
+class BatchPublishRequest(BaseModel):
+    unique_id: str | None = Field(None, title="Subscription unique ID for messages that don't name one")
+    messages: List[BatchMessage] = Field(..., min_items=1, max_items=PUBLISH_MAX_BATCH, title="Messages to publish")
+
+
+class BatchPublishResult(BaseModel):
+    unique_id: str | None = Field(None, title="Subscription unique ID")
+    job_id: str | None = Field(None, title="Publish job ID, shared by all messages of the subscription")
+    error: str | None = Field(None, title="Why the message was not accepted")
+
+
+class BatchPublishResponse(BaseModel):
+    results: List[BatchPublishResult] = Field(..., title="One result per message, in request order")
+
+
+class AccountSummaryResponse(BaseModel):
+    total: int = Field(0, title="Messages ever delivered to the account's postboxes")
+    unread: int = Field(0, title="Unread messages in all postboxes")
+    important_unread: int = Field(0, title="Important messages among the unread ones")
+    last_at: int | None = Field(None, title="Unix timestamp of the newest message")
+    postboxes: List[PostboxSummary] = Field(..., title="One summary per postbox")
+
+
+class PublishJobResponse(BaseModel):
+    job_id: str = Field(..., title="Publish job ID")
+    status: str = Field(..., title="pending, running, done or failed")
+    total: int | None = Field(None, title="Number of subscriber postboxes, known once the job started")
+    done: int = Field(0, title="Number of postboxes the message was delivered to")
+    lag: float = Field(0, title="Seconds between publishing and the start of the fan-out")
+
+
 @router.post("/", response_model=CreateAccountResponse, summary="Create an account")
-def create_account(response: Response):
-    res = DB.accounts_create()
+async def create_account(response: Response):
+    res = await DB.accounts_create()
     response.status_code = 201
     return CreateAccountResponse(**res)
 
 
 @router.get("/{account_id:str}", response_model=GetAccountResponse, summary="Get an account info by ID")
-def get_account(account_id: str):
-    account = DB.accounts_get(account_id)
-    return GetAccountResponse(**account)
+async def get_account(account_id: str):
+    account = await DB.accounts_get(account_id)
+    return GetAccountResponse(**{**account, "devices": await DB.devices_list(account_id)})
 
 
 @router.post("/{account_id:str}/devices", summary="Add a device to an account")
-def create_device(account_id: str, request: CreateDeviceRequest, response: Response):
-    account = DB.accounts_get(account_id)
-    full_device_id = f"{request.device_type}:{request.device_id}"
-    dev = efl(account["devices"], "device_id", full_device_id)
-    if not dev:
-        DB.accounts_add_device(account_id, full_device_id)
+async def create_device(account_id: str, request: CreateDeviceRequest, response: Response):
+    await DB.accounts_get(account_id)
+    await DB.accounts_add_device(account_id, f"{request.device_type}:{request.device_id}")
     response.status_code = 201
     return
 
 
 @router.get("/{account_id:str}/postboxes", response_model=GetPostboxesResponse, summary="Get list of postboxes of an account")
-def get_postboxes(account_id: str):
-    account = DB.accounts_get(account_id)
+async def get_postboxes(account_id: str):
+    account = await DB.accounts_get(account_id)
     return GetPostboxesResponse(postboxes=account["postboxes"])
 
 
+@router.post("/{account_id:str}/retention", summary="Set how long messages of the account are kept")
+async def set_retention(account_id: str, request: RetentionRequest, response: Response):
+    account = await DB.accounts_get(account_id)
+    await DB.accounts_set_retention(account, request.days)
+    response.status_code = 200
+    return
+
+
 @router.post("/{account_id:str}/subscriptions", summary="Subscribe account to a subscription")
-def create_subscription(account_id: str, request: CreateSubscriptionRequest, response: Response):
-    account = DB.accounts_get(account_id)
+async def create_subscription(account_id: str, request: CreateSubscriptionRequest, response: Response):
+    account = await DB.accounts_get(account_id, fresh=True)
 
-    subscription_account = DB.accounts_get_by_filter({"subscriptions.unique_id": request.unique_id})
-    if not subscription_account:
+    if not await DB.routes_get("unique", request.unique_id):
         raise HTTPException(status_code=406, detail="Subscription not found")
     if efl(account["postboxes"], "subscription", request.unique_id):
         raise HTTPException(status_code=409, detail="Already subscribed")
     postbox_id = create_random_string()
-    DB.accounts_push_to(account_id, "postboxes", {
+    await DB.postboxes_create(account, {
         "postbox_id": postbox_id,
         "subscription": request.unique_id,
         "created_at": int(time.time()),
         "meta": request.meta.dict() if request.meta else {}})
-    DB.accounts_push_to(
-        {"_id": subscription_account["_id"], "subscriptions.unique_id": request.unique_id},
-        "subscriptions.$.subscribers", postbox_id)
+    await DB.subscriptions_add_subscriber(request.unique_id, postbox_id)
     response.status_code = 201
     return
 
 
-@router.post("/{account_id:str}/subscriptions/{unique_id:str}", summary="Send message to subscription owned by account")
-def send_subscription_message(account_id: str, unique_id: str, request: IncomingMessage, response: Response):
-    account = DB.accounts_get(account_id, exception="Subscription with this ID does not exist")
-    subscriptions = account["subscriptions"]
-    subscription = efl(subscriptions, "unique_id", unique_id)
+@router.post("/{account_id:str}/subscriptions/{unique_id:str}", response_model=PublishResponse, summary="Send message to subscription owned by account")
+async def send_subscription_message(account_id: str, unique_id: str, request: IncomingMessage, response: Response):
+    account = await DB.accounts_get(account_id, exception="Subscription with this ID does not exist")
+    subscription = efl(account["subscriptions"], "unique_id", unique_id)
+    if not subscription:
+        # maybe created on another worker after our copy of the account was cached
+        account = await DB.accounts_get(account_id, fresh=True)
+        subscription = efl(account["subscriptions"], "unique_id", unique_id)
     if not subscription:
         raise HTTPException(status_code=400, detail=f"Subscription `{unique_id}` not belong to this account")
+    await ADMISSION.admit_publish(account_id, {unique_id: 1})
     with DB as db:
-        put_message_to_subscription(db, subscription["subscription_id"], request.dict())
-        db.accounts.update_one(
-            {"_id": account["_id"], "subscriptions.subscription_id": subscription["subscription_id"]},
-            {"$set": {"subscriptions.$.updated_at": int(time.time())}})
+        job_id = await fanout.submit_job(db, account_id, subscription["subscription_id"], request.dict())
+    await DB.subscriptions_set(account, subscription["subscription_id"], {"updated_at": int(time.time())})
     response.status_code = 202
-    return
+    return PublishResponse(job_id=str(job_id))
+
+
+@router.post("/{account_id:str}/publish", response_model=BatchPublishResponse, summary="Send many messages to subscriptions owned by account")
+async def send_batch(account_id: str, request: BatchPublishRequest, response: Response):
+    account = await DB.accounts_get(account_id)
+    subscriptions = {subscription["unique_id"]: subscription for subscription in account["subscriptions"]}
+    if any((message.unique_id or request.unique_id) not in subscriptions for message in request.messages):
+        account = await DB.accounts_get(account_id, fresh=True)
+        subscriptions = {subscription["unique_id"]: subscription for subscription in account["subscriptions"]}
+    batches: Dict[str, list] = {}
+    results = []
+    for message in request.messages:
+        unique_id = message.unique_id or request.unique_id
+        subscription = subscriptions.get(unique_id)
+        if not subscription:
+            results.append(BatchPublishResult(unique_id=unique_id, error=f"Subscription `{unique_id}` not belong to this account"))
+            continue
+        batches.setdefault(subscription["subscription_id"], []).append(message.dict(exclude={"unique_id"}))
+        results.append(BatchPublishResult(unique_id=unique_id))
+    if batches:
+        # the whole batch is admitted or refused, a retry after Retry-After resends all of it
+        await ADMISSION.admit_publish(account_id, collections.Counter(result.unique_id for result in results if result.error is None))
+        with DB as db:
+            jobs = await fanout.submit_jobs(db, account_id, batches)
+        for result in results:
+            if result.error is None:
+                result.job_id = str(jobs[subscriptions[result.unique_id]["subscription_id"]])
+        for subscription_id in jobs:
+            await DB.subscriptions_set(account, subscription_id, {"updated_at": int(time.time())})
+    response.status_code = 202 if batches else 400
+    return BatchPublishResponse(results=results)
+
+
+@router.get("/{account_id:str}/jobs/{job_id:str}", response_model=PublishJobResponse, summary="Get progress of a publish job")
+async def get_publish_job(account_id: str, job_id: str):
+    try:
+        job_oid = ObjectId(job_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Job not found")
+    with DB as db:
+        job = await db.publish_jobs.find_one({"_id": job_oid, "account_id": account_id})
+    if not job:
+        raise HTTPException(status_code=400, detail="Job not found")
+    return PublishJobResponse(job_id=job_id, status=job["status"], total=job["total"], done=job["done"], lag=fanout.job_lag(job))
 
 
 @router.get("/{account_id:str}/messages", response_model=postbox.GetMessagesResponse, summary="Get all messages from an account")
-def get_all_messages(account_id: str, response: Response):
-    messages = []
+async def get_all_messages(
+    account_id: str,
+    limit: int = Query(MESSAGES_LIMIT, ge=1, le=MESSAGES_MAX_LIMIT, title="Page size"),
+    after: str | None = Query(None, title="Cursor from the `next` field of the previous page"),
+    since: int | None = Query(None, title="Only messages created at or after this Unix timestamp"),
+    order: str = Query("asc", regex="^(asc|desc)$", title="asc for oldest first, desc for newest first"),
+):
     with DB as db:
-        for message in db.messages.find({"account_id": account_id}):
-            message["id"] = str(message["_id"])
-            messages.append(message)
+        messages, next_cursor = await find_messages(db, {"account_id": account_id}, limit, after, since, order)
+    return ORJSONResponse({"messages": messages, "next": next_cursor})
 
+
+@router.get("/{account_id:str}/messages/export", response_class=StreamingResponse, summary="Stream all messages of an account as NDJSON")
+async def export_all_messages(account_id: str, since: int | None = Query(None, title="Only messages created at or after this Unix timestamp")):
+    with DB as db:
+        return StreamingResponse(stream_messages(db, {"account_id": account_id}, since), media_type="application/x-ndjson")
+
+
+@router.get("/{account_id:str}/summary", response_model=AccountSummaryResponse, summary="Get unread counters of all postboxes of an account")
+async def get_summary(account_id: str):
+    # counters are maintained on every write, this reads one small document per postbox and no messages
+    account = await DB.accounts_get(account_id)
+    summaries = {summary["_id"]: summary for summary in await DB.summaries_list(account_id)}
+    postboxes = [postbox_summary(p["postbox_id"], summaries.get(p["postbox_id"])) for p in account["postboxes"]]
+    return ORJSONResponse({
+        "total": sum(p["total"] for p in postboxes),
+        "unread": sum(p["unread"] for p in postboxes),
+        "important_unread": sum(p["important_unread"] for p in postboxes),
+        "last_at": max((p["last_at"] for p in postboxes if p["last_at"] is not None), default=None),
+        "postboxes": postboxes,
+    })
+
+
+@router.post("/{account_id:str}/read", summary="Mark all messages of all postboxes of an account as read")
+async def mark_read(account_id: str, response: Response):
+    account = await DB.accounts_get(account_id)
+    for p in account["postboxes"]:
+        await DB.summaries_read(p["postbox_id"])
     response.status_code = 200
-    return postbox.GetMessagesResponse(messages=messages)
+    return
@@ -0,0 +1,177 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+from typing import Dict, List
+
+import motor.motor_asyncio
+import pymongo
+from bson import ObjectId
+
+import metrics
+from mongodb import DB
+from .meta import fanout_width, merge_meta, put_messages_to_postboxes, resolve_subscription
+
+# jobs expanded at once by every worker process
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS", 4))
+# progress is saved (and the lease renewed) after every chunk of this many message copies
+FANOUT_CHUNK = 100
+# a job not renewed for this long is taken over by another worker
+FANOUT_LEASE = 60
+# a job that failed this many times is given up as failed instead of retried forever
+FANOUT_ATTEMPTS = int(os.environ.get("FANOUT_ATTEMPTS", 5))
+
+fanout_jobs = metrics.Counter("fanout_jobs_total", "Publish jobs by outcome", ("status",))
+fanout_job_seconds = metrics.Histogram("fanout_job_seconds", "Time to expand a publish job")
+fanout_lag_seconds = metrics.Histogram("fanout_lag_seconds", "Time a publish job waited before expansion started")
+
+
+async def submit_job(db: motor.motor_asyncio.AsyncIOMotorDatabase, account_id: str, subscription_id: str, message: dict) -> ObjectId:
+    return (await submit_jobs(db, account_id, {subscription_id: [message]}))[subscription_id]
+
+
+async def submit_jobs(db: motor.motor_asyncio.AsyncIOMotorDatabase, account_id: str, batches: Dict[str, List[dict]]) -> Dict[str, ObjectId]:
+    # one job per subscription, carrying every message published to it
+    now = time.time()
+    res = await db.publish_jobs.insert_many([
+        {
+            "account_id": account_id,
+            "subscription_id": subscription_id,
+            "messages": messages,
+            "status": "pending",
+            "total": None,
+            "done": 0,
+            "created_at": now,
+            "lease_until": 0,
+        }
+        for subscription_id, messages in batches.items()
+    ])
+    pool.wake()
+    return dict(zip(batches, res.inserted_ids))
+
+
+def job_lag(job: dict) -> float:
+    return job.get("started_at", time.time()) - job["created_at"]
+
+
+class FanoutPool:
+    def __init__(self, workers: int = FANOUT_WORKERS):
+        self.workers = workers
+        self.tasks: list[asyncio.Task] = []
+        self.event: asyncio.Event | None = None
+        self.lag = 0.0
+        self.jobs_done = 0
+        self.messages_done = 0
+
+    def start(self):
+        self.event = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def wake(self):
+        if self.event is not None:
+            self.event.set()
+
+    async def stats(self) -> dict:
+        with DB as db:
+            pending = await db.publish_jobs.count_documents({"status": {"$in": ["pending", "running"]}})
+        return {"pending": pending, "lag": self.lag, "jobs_done": self.jobs_done, "messages_done": self.messages_done}
+
+    @staticmethod
+    async def claim() -> dict | None:
+        now = time.time()
+        with DB as db:
+            return await db.publish_jobs.find_one_and_update(
+                {"status": {"$in": ["pending", "running"]}, "lease_until": {"$lt": now}},
+                {"$set": {"status": "running", "lease_until": now + FANOUT_LEASE}, "$min": {"started_at": now}, "$inc": {"attempts": 1}},
+                sort=[("created_at", pymongo.ASCENDING)],
+                return_document=pymongo.ReturnDocument.AFTER,
+            )
+
+    @staticmethod
+    async def update(job_id: ObjectId, fields: dict):
+        with DB as db:
+            await db.publish_jobs.update_one({"_id": job_id}, {"$set": fields})
+
+    @staticmethod
+    async def finish(job_id: ObjectId, status: str, fields: dict | None = None):
+        # finished jobs keep only their progress, the TTL index on finished_at removes them later
+        with DB as db:
+            await db.publish_jobs.update_one({"_id": job_id}, {
+                "$set": {**(fields or {}), "status": status, "finished_at": datetime.datetime.utcnow()},
+                "$unset": {"messages": "", "message": ""}})
+
+    async def worker(self):
+        while True:
+            self.event.clear()
+            try:
+                await self.work()
+            except Exception as e:
+                # claiming or giving up hit mongo at a bad moment, the worker keeps going
+                logging.error(f"Fan-out worker failed: {e!r}")
+                await asyncio.sleep(1)
+
+    async def work(self):
+        job = await self.claim()
+        if job is None:
+            try:
+                await asyncio.wait_for(self.event.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+            return
+        # a worker that died on it never got to count the failure
+        if job["attempts"] > FANOUT_ATTEMPTS:
+            return await self.give_up(job)
+        try:
+            await self.expand(job)
+        except Exception as e:
+            fanout_jobs.inc(status="error")
+            logging.error(f"Fan-out job {job['_id']} failed (attempt {job['attempts']}): {e!r}")
+            # the lease stays, another attempt starts once it expires
+            if job["attempts"] >= FANOUT_ATTEMPTS:
+                await self.give_up(job)
+
+    async def give_up(self, job: dict):
+        logging.error(f"Fan-out job {job['_id']} failed {job['attempts']} times, giving up")
+        fanout_jobs.inc(status="failed")
+        await self.finish(job["_id"], "failed")
+
+    async def expand(self, job: dict):
+        self.lag = job_lag(job)
+        fanout_lag_seconds.observe(self.lag)
+        with fanout_job_seconds.time():
+            status = await self.expand_job(job)
+        fanout_jobs.inc(status=status)
+
+    async def expand_job(self, job: dict) -> str:
+        with DB as db:
+            resolved = await resolve_subscription(db, job["subscription_id"])
+        if not resolved:
+            await self.finish(job["_id"], "failed")
+            return "failed"
+        subscribers, meta = resolved
+        # jobs queued before batches carry a single `message`; contents are written once for all subscribers
+        messages = [{**message, "meta": merge_meta(meta, message["meta"]), "content_id": await DB.contents_put(message)}
+                    for message in job.get("messages") or [job["message"]]]
+        fanout_width.observe(len(subscribers))
+        chunk_size = max(1, FANOUT_CHUNK // len(messages))
+
+        # resumed jobs skip the subscribers an earlier attempt already covered
+        for start in range(job["done"], len(subscribers), chunk_size):
+            chunk = subscribers[start:start + chunk_size]
+            self.messages_done += await put_messages_to_postboxes(db, chunk, messages)
+            await self.update(job["_id"], {
+                "total": len(subscribers), "done": start + len(chunk), "lease_until": time.time() + FANOUT_LEASE})
+        await self.finish(job["_id"], "done", {"total": len(subscribers), "done": len(subscribers)})
+        self.jobs_done += 1
+        logging.info(f"Fan-out job {job['_id']} expanded {len(messages)} messages to {len(subscribers)} postboxes, lag {self.lag:.3f}s")
+        return "done"
+
+
+pool = FanoutPool()
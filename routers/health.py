@@ -1,7 +1,12 @@
 import time
-from fastapi import APIRouter
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel, Field
 
+import metrics
+from mongodb import DB
+from . import fanout
+
 router = APIRouter()
 
 
@@ -11,5 +16,36 @@ class HealthResponse(BaseModel):
 
 
 @router.get("/health")
-def health():
+async def health():
     return {"status": "ok", "time": int(time.time())}
+
+
+@router.get("/ready", summary="Whether this worker is warmed up and its database answers")
+async def ready(request: Request, response: Response):
+    db = await DB.status()
+    warm = getattr(request.app.state, "ready", False)
+    if not (warm and db["ok"]):
+        response.status_code = 503
+    return {"status": "ready" if warm and db["ok"] else "unavailable", "warm": warm, "db": db}
+
+
+@router.get("/health/fanout")
+async def health_fanout():
+    return await fanout.pool.stats()
+
+
+@router.get("/health/cache")
+async def health_cache():
+    return DB.cache_stats()
+
+
+@router.get("/health/retention")
+async def health_retention():
+    with DB as db:
+        run = await db.retention_runs.find_one({}, {"_id": 0}, sort=[("started_at", -1)])
+    return run or {}
+
+
+@router.get("/metrics", response_class=PlainTextResponse, summary="Prometheus metrics of all workers")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, defaultdict
+
+import orjson
+import pymongo
+
+from mongodb import DB
+
+QUEUE_SIZE = 1000
+# what a full listener queue does with a new event: drop the oldest, coalesce per postbox or disconnect the consumer
+POLICIES = ("drop", "coalesce", "disconnect")
+
+
+class SlowConsumer(Exception):
+    pass
+
+
+def decode_message(message: dict) -> dict:
+    message["id"] = str(message.pop("_id"))
+    for key in ("is_deleted", "is_sent", "account_id"):
+        message.pop(key, None)
+    return message
+
+
+# bounded per-connection queue, one connection may listen on many accounts and postboxes through it
+class Sink:
+    def __init__(self, size: int = QUEUE_SIZE, policy: str = "drop"):
+        self.size = size
+        self.policy = policy
+        self.events: OrderedDict[int, tuple] = OrderedDict()
+        self.latest: dict[str, int] = {}
+        self.seq = 0
+        self.dropped = 0
+        self.closed = False
+        self.ready = asyncio.Event()
+
+    def put(self, event: tuple):
+        postbox_id = event[0]["postbox_id"]
+        if len(self.events) >= self.size:
+            if self.policy == "disconnect":
+                self.closed = True
+            elif self.policy == "coalesce" and postbox_id in self.latest:
+                # the client only needs to learn the postbox changed, the newest message stands for the rest
+                del self.events[self.latest.pop(postbox_id)]
+            else:
+                self.pop()
+            self.dropped += 1
+        if not self.closed:
+            self.seq += 1
+            self.events[self.seq] = event
+            self.latest[postbox_id] = self.seq
+        self.ready.set()
+
+    async def get(self) -> tuple:
+        while not self.events:
+            if self.closed:
+                raise SlowConsumer()
+            self.ready.clear()
+            await self.ready.wait()
+        if self.closed:
+            raise SlowConsumer()
+        return self.pop()
+
+    def pop(self) -> tuple:
+        seq, event = self.events.popitem(last=False)
+        if self.latest.get(event[0]["postbox_id"]) == seq:
+            del self.latest[event[0]["postbox_id"]]
+        return event
+
+
+# one tailing cursor per process, fanned out to per-account and per-postbox listener sinks
+class TailHub:
+    def __init__(self):
+        self.listeners: dict[tuple[str, str], set[Sink]] = defaultdict(set)
+        self.task: asyncio.Task | None = None
+
+    def subscribe(self, kind: str, key: str, sink: Sink | None = None) -> Sink:
+        sink = sink or Sink()
+        self.listeners[(kind, key)].add(sink)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return sink
+
+    def unsubscribe(self, kind: str, key: str, sink: Sink):
+        sinks = self.listeners.get((kind, key))
+        if sinks is None:
+            return
+        sinks.discard(sink)
+        if not sinks:
+            del self.listeners[(kind, key)]
+
+    def connections(self) -> int:
+        return len(set().union(*self.listeners.values()))
+
+    def sinks(self, message: dict) -> set[Sink]:
+        targets = [("account", message["account_id"]), ("postbox", message["postbox_id"])]
+        return set().union(*(self.listeners.get(target, ()) for target in targets))
+
+    def publish(self, message: dict):
+        sinks = self.sinks(message)
+        if not sinks:
+            return
+        # decode and encode once, every listener gets the same event, once even if it listens on both targets
+        decoded = decode_message(message)
+        event = (decoded, orjson.dumps(decoded).decode())
+        for sink in sinks:
+            sink.put(event)
+
+    async def run(self):
+        # start from the live tail, ids seen in the current second guard against redelivery after a reopen
+        last_created_at = int(time.time())
+        seen = set()
+        while True:
+            try:
+                with DB as db:
+                    cursor = db.messages.find(
+                        {"is_deleted": False, "created_at": {"$gte": last_created_at}},
+                        cursor_type=pymongo.CursorType.TAILABLE_AWAIT,
+                        oplog_replay=True,
+                    )
+                while cursor.alive:
+                    async for message in cursor:
+                        if message["_id"] in seen:
+                            continue
+                        if message["created_at"] > last_created_at:
+                            last_created_at = message["created_at"]
+                            seen.clear()
+                        seen.add(message["_id"])
+                        # content is only looked up for messages somebody listens to
+                        if self.sinks(message):
+                            await DB.contents_join([message])
+                            self.publish(message)
+            except Exception as e:
+                logging.error(f"Tail hub cursor failed: {e!r}")
+            await asyncio.sleep(1)
@@ -1,10 +1,25 @@
+import asyncio
+import base64
+import collections
+import itertools
 import random
 import string
 import time
+from bson import ObjectId
+from bson.errors import InvalidId
 from fastapi import HTTPException
 from pydantic import BaseModel, Field
-from typing import List, Dict
-import pymongo.database
+from typing import AsyncIterator, List, Dict, Tuple
+import motor.motor_asyncio
+import orjson
+import pymongo
+
+import metrics
+from mongodb import DB
+
+postbox_messages = metrics.Counter("postbox_messages_total", "Messages written to postboxes", ("result",))
+postbox_batch_put_seconds = metrics.Histogram("postbox_batch_put_seconds", "Time to write a batch of messages to a chunk of postboxes")
+fanout_width = metrics.Histogram("fanout_width", "Subscriber postboxes per published message", buckets=metrics.WIDTH_BUCKETS)
 
 
 def create_random_string(length: int = 32) -> str:
@@ -38,6 +53,113 @@ class Message(BaseModel):
 
     postbox_id: str = Field(..., title="Postbox ID")
     created_at: int = Field(..., title="Created At")
+    seq: int | None = Field(None, title="Position in the account's message stream, the realtime event id")
+
+
+# internal fields never leave the server
+MESSAGE_PROJECTION = {"is_deleted": 0, "is_sent": 0, "account_id": 0}
+MESSAGES_LIMIT = 100
+MESSAGES_MAX_LIMIT = 1000
+# messages accepted by one batch publish request
+PUBLISH_MAX_BATCH = 500
+# characters of the body kept in a postbox summary
+PREVIEW_LENGTH = 140
+
+
+def encode_cursor(message: dict) -> str:
+    return base64.urlsafe_b64encode(f"{message['created_at']}:{message['_id']}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[int, ObjectId]:
+    try:
+        created_at, oid = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        return int(created_at), ObjectId(oid)
+    except (ValueError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def find_messages(db: motor.motor_asyncio.AsyncIOMotorDatabase, query: dict, limit: int = MESSAGES_LIMIT,
+                        after: str | None = None, since: int | None = None, order: str = "asc") -> Tuple[List[Dict], str | None]:
+    # (created_at, _id) is the sort key and the index suffix, pages are range scans of `limit` documents
+    direction = pymongo.ASCENDING if order == "asc" else pymongo.DESCENDING
+    query = {**query, "is_deleted": False}
+    if since is not None:
+        query["created_at"] = {"$gte": since}
+    if after is not None:
+        created_at, oid = decode_cursor(after)
+        op = "$gt" if direction == pymongo.ASCENDING else "$lt"
+        query["$or"] = [{"created_at": {op: created_at}}, {"created_at": created_at, "_id": {op: oid}}]
+    cursor = db.messages.find(query, MESSAGE_PROJECTION) \
+        .sort([("created_at", direction), ("_id", direction)]).limit(limit)
+    messages = []
+    async for message in cursor:
+        messages.append(message)
+    next_cursor = encode_cursor(messages[-1]) if len(messages) == limit else None
+    for message in await DB.contents_join(messages):
+        message["id"] = str(message.pop("_id"))
+    return messages, next_cursor
+
+
+async def stream_messages(db: motor.motor_asyncio.AsyncIOMotorDatabase, query: dict, since: int | None = None) -> AsyncIterator[bytes]:
+    # NDJSON lines are encoded a batch at a time while the cursor is being read, nothing holds the whole mailbox
+    query = {**query, "is_deleted": False}
+    if since is not None:
+        query["created_at"] = {"$gte": since}
+    cursor = db.messages.find(query, MESSAGE_PROJECTION).sort([("created_at", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]) \
+        .batch_size(MESSAGES_LIMIT)
+    batch = []
+    async for message in cursor:
+        batch.append(message)
+        if len(batch) < MESSAGES_LIMIT:
+            continue
+        for line in await encode_lines(batch):
+            yield line
+        batch = []
+    for line in await encode_lines(batch):
+        yield line
+
+
+async def encode_lines(messages: List[Dict]) -> List[bytes]:
+    lines = []
+    for message in await DB.contents_join(messages):
+        message["id"] = str(message.pop("_id"))
+        lines.append(orjson.dumps(message, option=orjson.OPT_APPEND_NEWLINE))
+    return lines
+
+
+class MessagePreview(BaseModel):
+    seq: int | None = Field(None, title="Position in the account's message stream")
+    id: str = Field(..., title="Message ID")
+    created_at: int = Field(..., title="Created At")
+    subject: str | None = Field("", title="Subject")
+    body: str | None = Field("", title=f"First {PREVIEW_LENGTH} characters of the body")
+    important: bool = Field(False, title="Important")
+
+
+class PostboxSummary(BaseModel):
+    postbox_id: str = Field(..., title="Postbox ID")
+    total: int = Field(0, title="Messages ever delivered to the postbox")
+    unread: int = Field(0, title="Messages delivered since the postbox was last marked read")
+    important_unread: int = Field(0, title="Important messages among the unread ones")
+    last_at: int | None = Field(None, title="Unix timestamp of the newest message")
+    last: MessagePreview | None = Field(None, title="Newest message")
+
+
+def postbox_summary(postbox_id: str, summary: Dict | None) -> Dict:
+    summary = summary or {}
+    last = summary.get("last")
+    return {
+        "postbox_id": postbox_id,
+        "total": summary.get("total", 0),
+        "unread": summary.get("unread", 0),
+        "important_unread": summary.get("important_unread", 0),
+        "last_at": last["created_at"] if last else None,
+        "last": last,
+    }
+
+
+class RetentionRequest(BaseModel):
+    days: int | None = Field(None, ge=1, le=365, title="Days to keep messages, null to inherit the default")
 
 
 class IncomingMessage(BaseModel):
@@ -49,43 +171,78 @@ class IncomingMessage(BaseModel):
     meta: Meta | None = Field({}, title="Meta")
 
 
-def put_message_to_subscription(db: pymongo.database.Database, subscription_id: str, message: Dict):
-    account = db.accounts.find_one({"subscriptions.subscription_id": subscription_id})
-    if not account:
+def merge_meta(meta: Dict | None, override: Dict | None) -> Dict:
+    merged = dict(meta or {})
+    for k, v in dict(override or {}).items():
+        if v:
+            merged[k] = v
+    return merged
+
+
+async def resolve_subscription(db: motor.motor_asyncio.AsyncIOMotorDatabase, subscription_id: str) -> Tuple[List[str], Dict] | None:
+    route = await DB.routes_get("subscription", subscription_id)
+    if not route:
         return None
-    subscription = efl(account["subscriptions"], "subscription_id", subscription_id)
+    subscription = await DB.subscriptions_get(route["account"], subscription_id)
     if not subscription:
         return None
-    meta = subscription.get("meta", {})
-    for k, v in dict(message["meta"]).items():
-        if v:
-            meta[k] = v
-    message["meta"] = meta
-    for postbox in subscription.get("subscribers", []):
-        put_message_to_postbox(db, postbox, message)
-
-
-def put_message_to_postbox(db: pymongo.database.Database, postbox_id: str, message: dict) -> bool:
-    account = db.accounts.find_one({"postboxes.postbox_id": postbox_id})
-    if not account:
-        return False
-    meta = efl(account["postboxes"], "postbox_id", postbox_id).get("meta", {})
-    for k, v in message.get("meta", {}).items():
-        if v:
-            meta[k] = v
-    db.messages.insert_one(
-        {
-            "subject": message["subject"],
-            "body": message["body"],
-            "url": message["url"],
-            "image_url": message["image_url"],
-            "important": message["important"],
-            "account_id": account["account_id"],
-            "postbox_id": postbox_id,
-            "created_at": int(time.time()),
-            "is_deleted": False,
-            "is_sent": False,
-            "meta": meta,
-        }
-    )
-    return True
+    return subscription.get("subscribers", []), subscription.get("meta") or {}
+
+
+def message_document(route: Dict, postbox_id: str, message: Dict, created_at: int, seq: int) -> Dict:
+    # a reference row, subject/body/urls live once per publish in db.contents
+    return {
+        "content_id": message["content_id"],
+        "important": message["important"],
+        "account_id": route["account_id"],
+        "postbox_id": postbox_id,
+        "created_at": created_at,
+        "seq": seq,
+        "is_deleted": False,
+        "is_sent": False,
+        "meta": merge_meta(route.get("meta"), message.get("meta")),
+    }
+
+
+def summary_entry(document: Dict, message: Dict, count: int, important: int) -> Dict:
+    # key order matters, $max on `last` compares seq first
+    return {
+        "postbox_id": document["postbox_id"],
+        "account_id": document["account_id"],
+        "count": count,
+        "important": important,
+        "last": {
+            "seq": document["seq"],
+            "id": str(document["_id"]),
+            "created_at": document["created_at"],
+            "subject": message.get("subject") or "",
+            "body": (message.get("body") or "")[:PREVIEW_LENGTH],
+            "important": bool(message.get("important")),
+        },
+    }
+
+
+async def put_messages_to_postboxes(db: motor.motor_asyncio.AsyncIOMotorDatabase, postbox_ids: List[str], messages: List[Dict]) -> int:
+    # every message to every postbox in one insert_many, routes come from the cache
+    with postbox_batch_put_seconds.time():
+        messages = [message if "content_id" in message else {**message, "content_id": await DB.contents_put(message)}
+                    for message in messages]
+        routes = await asyncio.gather(*(DB.routes_get("postbox", postbox_id) for postbox_id in postbox_ids))
+        targets = [(postbox_id, route) for postbox_id, route in zip(postbox_ids, routes) if route]
+        copies = collections.Counter(route["account_id"] for _, route in targets)
+        firsts = await asyncio.gather(*(DB.sequence_reserve(account_id, count * len(messages)) for account_id, count in copies.items()))
+        seqs = {account_id: itertools.count(first) for account_id, first in zip(copies, firsts)}
+        created_at = int(time.time())
+        documents = [message_document(route, postbox_id, message, created_at, next(seqs[route["account_id"]]))
+                     for postbox_id, route in targets for message in messages]
+        if documents:
+            await db.messages.insert_many(documents, ordered=False)
+            # documents are grouped by postbox, messages[-1] is the newest copy in each group
+            important = sum(1 for message in messages if message["important"])
+            await DB.summaries_add([summary_entry(documents[i + len(messages) - 1], messages[-1], len(messages), important)
+                                    for i in range(0, len(documents), len(messages))])
+    missing = sum(1 for route in routes if not route) * len(messages)
+    postbox_messages.inc(len(documents), result="stored")
+    if missing:
+        postbox_messages.inc(missing, result="no_postbox")
+    return len(documents)
@@ -1,10 +1,8 @@
-import time
-from copy import copy
-
-from fastapi import APIRouter, HTTPException, Response
+from fastapi import APIRouter, HTTPException, Query, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from mongodb import DB
-from .meta import IncomingMessage, Message, Meta, put_message_to_postbox, efl
+from .meta import MESSAGES_LIMIT, MESSAGES_MAX_LIMIT, Message, Meta, PostboxSummary, RetentionRequest, find_messages, postbox_summary, stream_messages
 
 router = APIRouter(prefix="/postboxes")
 
@@ -19,65 +17,74 @@ class SetPostboxMetaRequest(Meta):
 
 class GetMessagesResponse(BaseModel):
     messages: list[Message] = Field(..., title="Messages list")
-
-
-def remove_old_messages(db, account_id: str):
-    db.messages.update_many(
-        {
-            "account_id": account_id,
-            "created_at": {"$lt": int(time.time()) - 24 * 60 * 60 * 7},
-        },
-        {"$set": {"is_deleted": True}}
-    )
+    next: str | None = Field(None, title="Cursor of the next page, if there may be one")
 
 
 @router.delete("/{postbox_id}", summary="Delete postbox (and unsubscribe from the subscription)")
-def delete_postbox(postbox_id: str, response: Response):
-    account = DB.accounts_get_by_postbox(postbox_id, f"Postbox {postbox_id} not found")
+async def delete_postbox(postbox_id: str, response: Response):
+    account = await DB.accounts_get_by_postbox(postbox_id, f"Postbox {postbox_id} not found")
     response.status_code = 200
-    with DB as db:
-        db.accounts.update_one(
-            {"_id": account["_id"]},
-            {"$pull": {"postboxes": {"postbox_id": postbox_id}}}
-        )
-    unique_id = efl(account["postboxes"], "postbox_id", postbox_id).get("subscription")
-    if unique_id:
-        with DB as db:
-            db.accounts.update_one(
-                {"subscriptions.unique_id": unique_id},
-                {"$pull": {"subscriptions.$.subscribers": postbox_id}}
-            )
+    await DB.postboxes_delete(account, postbox_id)
     return
 
 @router.post("/{postbox_id}/meta", summary="Set postbox properties")
-def set_postbox_meta(postbox_id: str, request: SetPostboxMetaRequest, response: Response):
-    account = DB.accounts_get_by_postbox(postbox_id, f"Postbox {postbox_id} not found")
-    with DB as db:
-        postbox = efl(account["postboxes"], "postbox_id", postbox_id)
-        postbox["meta"] = request.dict()
-        db.accounts.update_one(
-            {"_id": account["_id"], "postboxes.postbox_id": postbox_id},
-            {"$set": {"postboxes.$": postbox}}
-        )
-        response.status_code = 200
-        return
+async def set_postbox_meta(postbox_id: str, request: SetPostboxMetaRequest, response: Response):
+    account = await DB.accounts_get_by_postbox(postbox_id, f"Postbox {postbox_id} not found")
+    await DB.postboxes_set_meta(account, postbox_id, request.dict())
+    response.status_code = 200
+    return
+
+
+@router.post("/{postbox_id}/retention", summary="Set how long messages of the postbox are kept")
+async def set_postbox_retention(postbox_id: str, request: RetentionRequest, response: Response):
+    account = await DB.accounts_get_by_postbox(postbox_id, f"Postbox {postbox_id} not found")
+    await DB.postboxes_set_retention(account, postbox_id, request.days)
+    response.status_code = 200
+    return
 
 
 @router.get("/{postbox_id}/meta", response_model=GetPostboxMetaResponse, summary="Get postbox properties")
-def get_postbox_meta(postbox_id: str, response: Response):
-    account = DB.accounts_get_by_postbox(postbox_id, f"Postbox {postbox_id} not found")
+async def get_postbox_meta(postbox_id: str, response: Response):
+    route = await DB.routes_get("postbox", postbox_id)
+    if not route:
+        raise HTTPException(status_code=400, detail=f"Postbox {postbox_id} not found")
     response.status_code = 200
-    postbox = efl(account["postboxes"], "postbox_id", postbox_id)
-    return GetPostboxMetaResponse(sender=postbox.get("sender"), icon=postbox.get("icon"), color=postbox.get("color"))
+    return GetPostboxMetaResponse(**route.get("meta", {}))
 
 
 @router.get("/{postbox_id}/messages", response_model=GetMessagesResponse, summary="Get list of messages for an postbox")
-def get_messages(postbox_id: str, response: Response):
-    messages = []
+async def get_messages(
+    postbox_id: str,
+    limit: int = Query(MESSAGES_LIMIT, ge=1, le=MESSAGES_MAX_LIMIT, title="Page size"),
+    after: str | None = Query(None, title="Cursor from the `next` field of the previous page"),
+    since: int | None = Query(None, title="Only messages created at or after this Unix timestamp"),
+    order: str = Query("asc", regex="^(asc|desc)$", title="asc for oldest first, desc for newest first"),
+):
+    with DB as db:
+        messages, next_cursor = await find_messages(db, {"postbox_id": postbox_id}, limit, after, since, order)
+    # documents come out of our own projection, skip re-validating them through the response model
+    return ORJSONResponse({"messages": messages, "next": next_cursor})
+
+
+@router.get("/{postbox_id}/messages/export", response_class=StreamingResponse, summary="Stream all messages of a postbox as NDJSON")
+async def export_messages(postbox_id: str, since: int | None = Query(None, title="Only messages created at or after this Unix timestamp")):
+    with DB as db:
+        return StreamingResponse(stream_messages(db, {"postbox_id": postbox_id}, since), media_type="application/x-ndjson")
+
+
+@router.get("/{postbox_id}/summary", response_model=PostboxSummary, summary="Get unread counters and the newest message of a postbox")
+async def get_summary(postbox_id: str):
+    route = await DB.routes_get("postbox", postbox_id)
+    if not route:
+        raise HTTPException(status_code=400, detail=f"Postbox {postbox_id} not found")
     with DB as db:
-        for message in db.messages.find({"postbox_id": postbox_id, 'is_deleted': False}):
-            message["id"] = copy(str(message["_id"]))
-            del message["_id"], message["is_deleted"], message["is_sent"], message["account_id"]
-            messages.append(message)
+        summary = await db.summaries.find_one({"_id": postbox_id})
+    return ORJSONResponse(postbox_summary(postbox_id, summary))
+
+
+@router.post("/{postbox_id}/read", summary="Mark all messages of a postbox as read")
+async def mark_read(postbox_id: str, response: Response):
+    await DB.accounts_get_by_postbox(postbox_id, f"Postbox {postbox_id} not found")
+    await DB.summaries_read(postbox_id)
     response.status_code = 200
-    return GetMessagesResponse(messages=messages)
+    return
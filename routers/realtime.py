@@ -1,45 +1,216 @@
 import asyncio
-import json
 import os
-from copy import copy
+from typing import AsyncIterator
 
-import motor.motor_asyncio
+import anyio
+import orjson
 import pymongo
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Header, Query, Request, WebSocket, WebSocketDisconnect
 from sse_starlette.sse import EventSourceResponse
 
-MONGO_HOST = os.environ.get("MONGO", "localhost")
+import metrics
+from admission import ADMISSION
+from mongodb import DB
+from .hub import POLICIES, Sink, SlowConsumer, TailHub
+from .meta import MESSAGE_PROJECTION
+
+# how often an idle stream checks whether the client is still there
+IDLE_TIMEOUT = 15
+# most messages replayed to a stream resuming from Last-Event-ID
+RESUME_LIMIT = int(os.environ.get("RESUME_LIMIT", 1000))
+# fan-out workers reserve seqs before inserting, so a lower seq may arrive after a higher one;
+# seqs missing this close below the newest one sent are remembered in the event id and looked for on resume
+SSE_HOLE_WINDOW = int(os.environ.get("SSE_HOLE_WINDOW", 100))
+# events waiting to be sent on one websocket before the slow-consumer policy kicks in
+WS_QUEUE_SIZE = int(os.environ.get("WS_QUEUE_SIZE", 256))
+WS_POLICY = os.environ.get("WS_POLICY", "drop")
+# accounts and postboxes one websocket may listen on
+WS_MAX_SUBSCRIPTIONS = int(os.environ.get("WS_MAX_SUBSCRIPTIONS", 100))
+# with acks on, at most this many messages are sent and not yet acknowledged
+WS_ACK_WINDOW = int(os.environ.get("WS_ACK_WINDOW", 32))
+# close code telling a client it was disconnected for not keeping up
+WS_SLOW_CONSUMER = 4008
 
 router = APIRouter(prefix="/realtime")
 
-client = motor.motor_asyncio.AsyncIOMotorClient(f"mongodb://{MONGO_HOST}:27017")
+realtime_streams = metrics.Gauge("realtime_streams", "Open realtime streams", ("transport",))
+realtime_dropped = metrics.Counter("realtime_dropped_total", "Events dropped or coalesced for slow consumers", ("transport",))
+
+hub = TailHub()
+
+
+class StreamResponse(EventSourceResponse):
+    # the admission slot goes back when the response is over, also when the client left before the first event
+    def __init__(self, content, stream_id: int | None, **kwargs):
+        super().__init__(content, **kwargs)
+        self.stream_id = stream_id
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await ADMISSION.close_stream(self.stream_id)
+
+
+class Delivered:
+    # event ids are "<highest seq sent>" or "<highest seq sent>:<hole>,<hole>..." for recent lower seqs not sent yet
+    def __init__(self, event_id: str | None):
+        high, _, holes = (event_id or "").partition(":")
+        self.high = int(high) if high.isdigit() else None
+        self.holes = {int(hole) for hole in holes.split(",") if hole.isdigit()} if self.high is not None else set()
+        # what the client already had when it resumed, anything else is news even below its high mark
+        self.resumed = (self.high, set(self.holes))
+        self.sent: set[int] = set()
+
+    def seen(self, seq: int) -> bool:
+        high, holes = self.resumed
+        return seq in self.sent or (high is not None and seq <= high and seq not in holes)
+
+    def add(self, seq: int):
+        if self.high is None:
+            self.high = seq
+        elif seq > self.high:
+            self.holes.update(range(max(self.high + 1, seq - SSE_HOLE_WINDOW), seq))
+            self.high = seq
+        self.holes.discard(seq)
+        self.sent.add(seq)
+        floor = self.high - SSE_HOLE_WINDOW
+        self.holes = {hole for hole in self.holes if hole > floor}
+        self.sent = {sent for sent in self.sent if sent > floor}
+
+    def since(self) -> int:
+        # a resumed stream reads from its oldest hole and skips what was seen
+        return min(self.holes) - 1 if self.holes else self.high
+
+    def event_id(self) -> str:
+        return f"{self.high}:{','.join(map(str, sorted(self.holes)))}" if self.holes else str(self.high)
+
+
+async def missed_messages(account_id: str, last_event_id: int) -> AsyncIterator[tuple]:
+    # (account_id, seq) index range, capped so a very stale client falls back to the listing API
+    with DB as db:
+        cursor = db.messages.find({"account_id": account_id, "seq": {"$gt": last_event_id}, "is_deleted": False},
+                                  MESSAGE_PROJECTION).sort("seq", pymongo.ASCENDING).limit(RESUME_LIMIT)
+    for message in await DB.contents_join(await cursor.to_list(None)):
+        message["id"] = str(message.pop("_id"))
+        yield message, orjson.dumps(message).decode()
 
 
 @router.get("/accounts/{account_id:str}/messages", summary="Get realtime updates with all the messages from an account")
-async def eventsource_get_account_messages(account_id: str, request: Request):
-    db = client.ondb
+async def eventsource_get_account_messages(account_id: str, request: Request, last_event_id: str | None = Header(None)):
+    # refused with 429 before the stream starts, the slot is given back when the response ends
+    stream_id = await ADMISSION.open_stream(account_id)
 
     async def event_generator():
-        first_run = True
-        last_created_at = 0
+        # listen before reading what was missed, so nothing falls between the two
+        sink = hub.subscribe("account", account_id)
+        realtime_streams.inc(transport="sse")
+        delivered = Delivered(last_event_id)
+        try:
+            if delivered.high is not None:
+                async for message, data in missed_messages(account_id, delivered.since()):
+                    if delivered.seen(message["seq"]):
+                        continue
+                    delivered.add(message["seq"])
+                    yield {"id": delivered.event_id(), "data": data}
+            while True:
+                # If client closes connection, stop sending events
+                if await request.is_disconnected():
+                    break
+                try:
+                    message, data = await asyncio.wait_for(sink.get(), IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    continue
+                seq = message.get("seq")
+                if seq is None:
+                    yield {"data": data}
+                    continue
+                if delivered.seen(seq):
+                    continue
+                delivered.add(seq)
+                yield {"id": delivered.event_id(), "data": data}
+        finally:
+            realtime_streams.dec(transport="sse")
+            realtime_dropped.inc(sink.dropped, transport="sse")
+            hub.unsubscribe("account", account_id, sink)
+
+    return StreamResponse(event_generator(), stream_id)
+
+
+# client frames: {"op": "subscribe"|"unsubscribe", "kind": "account"|"postbox", "key": ...} and {"op": "ack", "id": ...}
+# server frames: {"type": "message", "message": ...}, {"type": "subscribed"|"unsubscribed", "kind": ..., "key": ...}, {"type": "error", "detail": ...}
+# fastapi 0.74 does not apply the router prefix to websocket routes
+@router.websocket(f"{router.prefix}/ws")
+async def websocket_messages(
+    websocket: WebSocket,
+    policy: str = Query(WS_POLICY, regex=f"^({'|'.join(POLICIES)})$"),
+    ack: bool = Query(False),
+):
+    await websocket.accept()
+    sink = Sink(WS_QUEUE_SIZE, policy)
+    subscriptions: set[tuple[str, str]] = set()
+    unacked: set[str] = set()
+    acked = asyncio.Event()
+
+    async def receive():
         while True:
-            # If client closes connection, stop sending events
-            if await request.is_disconnected():
-                break
-
-            cursor = db.messages.find(
-                {"account_id": account_id, "is_deleted": False, "created_at": {"$gt": last_created_at}},
-                cursor_type=pymongo.CursorType.TAILABLE_AWAIT,
-                oplog_replay=True,
-            )
-            while cursor.alive:
-                async for message in cursor:
-                    last_created_at = message["created_at"]
-                    message["id"] = copy(str(message["_id"]))
-                    del message["_id"], message["is_deleted"], message["is_sent"], message["account_id"]
-                    if not first_run:
-                        yield {"data": json.dumps(message, ensure_ascii=False)}
-                first_run = False
-            await asyncio.sleep(1)
-
-    return EventSourceResponse(event_generator())
+            event = await websocket.receive()
+            if event["type"] == "websocket.disconnect":
+                return
+            try:
+                frame = orjson.loads(event.get("text") or event.get("bytes") or b"")
+            except orjson.JSONDecodeError:
+                # answered like any other frame we don't understand, the socket stays open
+                frame = None
+            op = frame.get("op") if isinstance(frame, dict) else None
+            if op == "ack":
+                unacked.discard(frame.get("id"))
+                acked.set()
+                continue
+            target = (frame.get("kind"), frame.get("key")) if op in ("subscribe", "unsubscribe") else None
+            if target is None or target[0] not in ("account", "postbox") or not isinstance(target[1], str):
+                await websocket.send_json({"type": "error", "detail": "Unknown operation"})
+            elif op == "subscribe" and target not in subscriptions and len(subscriptions) >= WS_MAX_SUBSCRIPTIONS:
+                await websocket.send_json({"type": "error", "detail": "Too many subscriptions"})
+            elif op == "subscribe":
+                subscriptions.add(target)
+                hub.subscribe(*target, sink)
+                await websocket.send_json({"type": "subscribed", "kind": target[0], "key": target[1]})
+            else:
+                subscriptions.discard(target)
+                hub.unsubscribe(*target, sink)
+                await websocket.send_json({"type": "unsubscribed", "kind": target[0], "key": target[1]})
+
+    async def send():
+        while True:
+            # an unacknowledging client stops the sender, the queue fills up and the policy decides
+            while ack and len(unacked) >= WS_ACK_WINDOW:
+                if sink.closed:
+                    raise SlowConsumer()
+                acked.clear()
+                try:
+                    await asyncio.wait_for(acked.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+            message, data = await sink.get()
+            if ack:
+                unacked.add(message["id"])
+            await websocket.send_text(f'{{"type":"message","message":{data}}}')
+
+    realtime_streams.inc(transport="websocket")
+    tasks = [asyncio.create_task(receive()), asyncio.create_task(send())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if isinstance(task.exception(), SlowConsumer):
+                await websocket.close(WS_SLOW_CONSUMER)
+            elif task.exception() and not isinstance(task.exception(), WebSocketDisconnect):
+                raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        for target in subscriptions:
+            hub.unsubscribe(*target, sink)
+        realtime_streams.dec(transport="websocket")
+        realtime_dropped.inc(sink.dropped, transport="websocket")
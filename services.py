@@ -2,7 +2,7 @@ class onlynoise:
     image = "docker.rubedo.cloud/onlynoise:latest"
     public = "onlynoise.rubedo.cloud @ 8080"
     watchtower = True
-    envs = {"MONGO": "mongo"}
+    envs = {"MONGO": "mongo", "METRICS_DIR": "/tmp/onlynoise-metrics", "ADMISSION_DB": "/tmp/onlynoise-admission.db"}
 
 
 class onlynoisepush:
@@ -13,6 +13,14 @@ class onlynoisepush:
     watchtower = True
 
 
+class onlynoiseretention:
+    image = "docker.rubedo.cloud/onlynoise-push:latest"
+    command = "retention.py"
+    envs = "MONGO=mongo"
+    networks = ["public"]
+    watchtower = True
+
+
 class mongo:
     image = "mongo:latest"
     command = "mongod --quiet"
@@ -0,0 +1,397 @@
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import pymongo
+
+import noti2
+from admission import STREAMS_PER_ACCOUNT
+from mongodb import DB
+from routers.meta import message_document
+from tools.fakeapns import FakeAPNs, create_client
+from tools.stats import summarize
+
+# parameter sweeps, --quick keeps only the small end of every one
+PUBLISH_SUBSCRIBERS = [1, 10, 100, 1000]
+LISTING_SIZES = [100, 1000, 10000]
+SSE_CONNECTIONS = [1, 10, 100]
+PUSH_DEVICES = [1, 10, 100, 1000]
+# bursts to more postboxes than the worker has dispatch slots, every postbox gets COALESCE_BURST messages
+COALESCE_POSTBOXES = [50, 500]
+COALESCE_CONCURRENCY = 10
+COALESCE_BURST = 5
+COALESCE_WINDOW = 2
+# how many times every measurement is repeated
+ROUNDS = 20
+# requests in flight while preparing fixtures
+SETUP_CONCURRENCY = 50
+# give up waiting for a message or a job after this many seconds
+WAIT_TIMEOUT = 30
+SCENARIOS = ["publish", "listing", "sse", "push", "coalesce"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_revision() -> str:
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"]) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{revision}-dirty" if dirty else revision
+
+
+# throwaway mongod in a temporary directory, so the benchmark never touches a real database
+class Mongod:
+    def __init__(self):
+        self.path = tempfile.mkdtemp(prefix="onlynoise-bench-")
+        self.port = free_port()
+        self.process: subprocess.Popen | None = None
+
+    def start(self) -> str:
+        binary = shutil.which("mongod")
+        if binary is None:
+            sys.exit("mongod not found in PATH, install it or point --mongo at a server you can wipe")
+        self.process = subprocess.Popen(
+            [binary, "--dbpath", self.path, "--port", str(self.port), "--bind_ip", "127.0.0.1", "--quiet"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = f"mongodb://127.0.0.1:{self.port}"
+        client = pymongo.MongoClient(url, serverSelectionTimeoutMS=30000)
+        client.admin.command("ping")
+        client.close()
+        return url
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class Api:
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+        self.setup = asyncio.Semaphore(SETUP_CONCURRENCY)
+
+    async def post(self, path: str, **body) -> dict:
+        async with self.setup:
+            res = await self.client.post(path, json=body)
+        res.raise_for_status()
+        return res.json() if res.content else {}
+
+    async def create_account(self) -> str:
+        return (await self.post("/v1/accounts/"))["account_id"]
+
+    async def create_channel(self, subscribers: int) -> tuple[str, str, list[str]]:
+        publisher = await self.create_account()
+        unique_id = (await self.post("/v1/subscriptions/", account_id=publisher))["unique_id"]
+        accounts = await asyncio.gather(*(self.create_account() for _ in range(subscribers)))
+        await asyncio.gather(*(self.post(f"/v1/accounts/{account}/subscriptions", unique_id=unique_id) for account in accounts))
+        return publisher, unique_id, list(accounts)
+
+    async def postbox_of(self, account_id: str) -> str:
+        res = await self.client.get(f"/v1/accounts/{account_id}/postboxes")
+        return res.json()["postboxes"][0]["postbox_id"]
+
+    async def publish(self, publisher: str, unique_id: str, body: str) -> str:
+        res = await self.client.post(f"/v1/accounts/{publisher}/subscriptions/{unique_id}", json={"subject": "bench", "body": body})
+        res.raise_for_status()
+        return res.json()["job_id"]
+
+    async def wait_job(self, publisher: str, job_id: str):
+        deadline = time.monotonic() + WAIT_TIMEOUT
+        while time.monotonic() < deadline:
+            job = (await self.client.get(f"/v1/accounts/{publisher}/jobs/{job_id}")).json()
+            if job["status"] in ("done", "failed"):
+                return job
+            await asyncio.sleep(0.002)
+        raise TimeoutError(f"publish job {job_id} did not finish in {WAIT_TIMEOUT}s")
+
+
+async def reference_rows(postbox_id: str, messages: list[tuple[str, int]], is_sent: bool) -> list[dict]:
+    # (body, created_at) pairs stored the way fan-out stores them: content once in db.contents, numbered reference rows
+    route = await DB.routes_get("postbox", postbox_id)
+    contents = [{"subject": "bench", "body": body, "url": "", "image_url": "", "important": False, "meta": {}} for body, _ in messages]
+    content_ids = await asyncio.gather(*(DB.contents_put(content) for content in contents))
+    first = await DB.sequence_reserve(route["account_id"], len(messages))
+    return [{**message_document(route, postbox_id, {**content, "content_id": content_id}, created_at, first + i), "is_sent": is_sent}
+            for i, (content, content_id, (_, created_at)) in enumerate(zip(contents, content_ids, messages))]
+
+
+async def bench_publish(api: Api, subscribers: list[int], rounds: int) -> list[dict]:
+    results = []
+    for count in subscribers:
+        publisher, unique_id, _ = await api.create_channel(count)
+        accepted, stored = [], []
+        for i in range(rounds):
+            started = time.perf_counter()
+            job_id = await api.publish(publisher, unique_id, f"publish {i}")
+            accepted.append(time.perf_counter() - started)
+            await api.wait_job(publisher, job_id)
+            stored.append(time.perf_counter() - started)
+        results.append({"subscribers": count, "accepted": summarize(accepted), "stored": summarize(stored)})
+        print(f"publish  subscribers={count:<6} stored p50={results[-1]['stored']['p50_ms']:.1f}ms p99={results[-1]['stored']['p99_ms']:.1f}ms")
+    return results
+
+
+async def bench_listing(api: Api, sizes: list[int], rounds: int) -> list[dict]:
+    results = []
+    with DB as db:
+        for size in sizes:
+            _, _, (account,) = await api.create_channel(1)
+            postbox_id = await api.postbox_of(account)
+            now = int(time.time())
+            for offset in range(0, size, 1000):
+                await db.messages.insert_many(await reference_rows(
+                    postbox_id, [(f"listing {i}", now - size + i) for i in range(offset, min(size, offset + 1000))], True))
+            first_page, newest_page = [], []
+            for _ in range(rounds):
+                started = time.perf_counter()
+                (await api.client.get(f"/v1/postboxes/{postbox_id}/messages")).raise_for_status()
+                first_page.append(time.perf_counter() - started)
+                started = time.perf_counter()
+                (await api.client.get(f"/v1/accounts/{account}/messages", params={"order": "desc"})).raise_for_status()
+                newest_page.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            exported = 0
+            async with api.client.stream("GET", f"/v1/postboxes/{postbox_id}/messages/export") as res:
+                async for _ in res.aiter_lines():
+                    exported += 1
+            export = time.perf_counter() - started
+            results.append({"messages": size, "first_page": summarize(first_page), "newest_page": summarize(newest_page),
+                            "export_ms": export * 1000, "exported": exported})
+            print(f"listing  messages={size:<6} page p50={results[-1]['first_page']['p50_ms']:.1f}ms export={export * 1000:.1f}ms")
+    return results
+
+
+async def bench_sse(api: Api, base_url: str, connections: list[int], rounds: int) -> list[dict]:
+    from routers.realtime import hub
+
+    results = []
+    for count in connections:
+        # listeners spread over enough accounts to stay under the per-account stream limit
+        publisher, unique_id, accounts = await api.create_channel(math.ceil(count / STREAMS_PER_ACCOUNT) if STREAMS_PER_ACCOUNT > 0 else 1)
+        sent: dict[str, float] = {}
+        latencies: list[float] = []
+        received = asyncio.Event()
+
+        async def listen(client: httpx.AsyncClient, listener: str):
+            async with client.stream("GET", f"/v1/realtime/accounts/{listener}/messages") as res:
+                res.raise_for_status()
+                async for line in res.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    body = json.loads(line[5:])["body"]
+                    latencies.append(time.perf_counter() - sent[body])
+                    if len(latencies) == count * rounds:
+                        received.set()
+
+        async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=httpx.Limits(max_connections=None)) as client:
+            listeners = [asyncio.create_task(listen(client, accounts[i % len(accounts)])) for i in range(count)]
+            deadline = time.monotonic() + WAIT_TIMEOUT
+            while hub.connections() < count:
+                if time.monotonic() > deadline:
+                    for task in listeners:
+                        task.cancel()
+                    raise RuntimeError(f"only {hub.connections()} of {count} SSE streams opened in {WAIT_TIMEOUT}s")
+                await asyncio.sleep(0.01)
+            for i in range(rounds):
+                body = f"sse {count} {i}"
+                sent[body] = time.perf_counter()
+                await api.publish(publisher, unique_id, body)
+                await asyncio.sleep(0.01)
+            try:
+                await asyncio.wait_for(received.wait(), WAIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            for task in listeners:
+                task.cancel()
+            await asyncio.gather(*listeners, return_exceptions=True)
+        results.append({"connections": count, "expected": count * rounds, "delivery": summarize(latencies)})
+        print(f"sse      connections={count:<6} delivered {len(latencies)}/{count * rounds} p50={results[-1]['delivery'].get('p50_ms', 0):.1f}ms")
+    return results
+
+
+async def bench_push(api: Api, devices: list[int], rounds: int, apns_latency: float) -> list[dict]:
+    fake = FakeAPNs(apns_latency)
+    await fake.start()
+    results = []
+    with DB as db:
+        for count in devices:
+            _, _, (account,) = await api.create_channel(1)
+            postbox_id = await api.postbox_of(account)
+            await db.devices.insert_many([{"account_id": account, "device_id": f"ios:{account}{i:08x}",
+                                           "token": f"{account}{i:08x}", "created_at": 0} for i in range(count)])
+            now = int(time.time())
+            res = await db.messages.insert_many(await reference_rows(postbox_id, [(f"push {i}", now) for i in range(rounds)], False))
+            messages = await db.messages.find({"_id": {"$in": res.inserted_ids}}).to_list(None)
+            fake.reset()
+            # coalescing off, every message of the burst is one push per device, raw send throughput is measured
+            dispatcher = noti2.Dispatcher(db, create_client(fake.port, max_connections=noti2.APNS_CONNECTIONS), window=0)
+            dispatcher.start()
+            started = time.perf_counter()
+            for message in messages:
+                await dispatcher.feed(message)
+            deadline = time.monotonic() + WAIT_TIMEOUT
+            while fake.requests < count * rounds and time.monotonic() < deadline:
+                await asyncio.sleep(0.001)
+            pushed = time.perf_counter() - started
+            while await db.messages.count_documents({"_id": {"$in": res.inserted_ids}, "is_sent": True}) < rounds \
+                    and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            marked = time.perf_counter() - started
+            await dispatcher.stop()
+            dispatcher.client.pool.close()
+            results.append({"devices": count, "messages": rounds, "pushes": fake.requests,
+                            "pushes_per_second": fake.requests / pushed, "pushed_ms": pushed * 1000, "marked_sent_ms": marked * 1000})
+            print(f"push     devices={count:<6} {fake.requests} pushes, {results[-1]['pushes_per_second']:.0f}/s")
+    fake.stop()
+    return results
+
+
+async def bench_coalesce(api: Api, postboxes: list[int], apns_latency: float) -> list[dict]:
+    # held messages must not keep dispatch slots, or bursts wider than the concurrency are never merged
+    fake = FakeAPNs(apns_latency)
+    await fake.start()
+    results = []
+    with DB as db:
+        for count in postboxes:
+            _, _, accounts = await api.create_channel(count)
+            postbox_ids = await asyncio.gather(*(api.postbox_of(account) for account in accounts))
+            await db.devices.insert_many([{"account_id": account, "device_id": f"ios:{account}", "token": account, "created_at": 0}
+                                          for account in accounts])
+            now = int(time.time())
+            bursts = await asyncio.gather(*(reference_rows(postbox_id, [(f"burst {i}", now) for i in range(COALESCE_BURST)], False)
+                                            for postbox_id in postbox_ids))
+            # interleaved, every postbox gets its first message before any gets its second
+            res = await db.messages.insert_many([row for rows in zip(*bursts) for row in rows])
+            messages = await db.messages.find({"_id": {"$in": res.inserted_ids}}).to_list(None)
+            fake.reset()
+            dispatcher = noti2.Dispatcher(db, create_client(fake.port, max_connections=noti2.APNS_CONNECTIONS),
+                                          concurrency=COALESCE_CONCURRENCY, window=COALESCE_WINDOW)
+            dispatcher.start()
+            started = time.perf_counter()
+            for message in messages:
+                await dispatcher.feed(message)
+            deadline = time.monotonic() + WAIT_TIMEOUT
+            while await db.messages.count_documents({"_id": {"$in": res.inserted_ids}, "is_sent": True}) < len(messages) \
+                    and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            elapsed = time.perf_counter() - started
+            await dispatcher.stop()
+            dispatcher.client.pool.close()
+            # the first message of every postbox goes out at once, the rest of its burst in one merged push
+            expected = 2 * count
+            results.append({"postboxes": count, "messages": len(messages), "pushes": fake.requests, "expected_pushes": expected,
+                            "coalesced": fake.requests <= expected, "marked_sent_ms": elapsed * 1000})
+            print(f"coalesce postboxes={count:<6} {fake.requests} pushes for {len(messages)} messages (at most {expected})"
+                  f"{'' if fake.requests <= expected else ' NOT COALESCED'}, {elapsed * 1000:.0f}ms")
+    fake.stop()
+    return results
+
+
+def compare(previous: dict, current: dict):
+    # one line per measured point, positive change is slower (or fewer pushes per second)
+    print(f"\nchange against {previous.get('revision')}:")
+    for scenario, points in current["results"].items():
+        for old, new in zip(previous.get("results", {}).get(scenario, []), points):
+            for key, value in new.items():
+                if isinstance(value, dict) and "p50_ms" in value and old.get(key, {}).get("p50_ms"):
+                    change = value["p50_ms"] / old[key]["p50_ms"] - 1
+                elif key == "pushes_per_second" and old.get(key):
+                    change = old[key] / value - 1
+                else:
+                    continue
+                label = ", ".join(f"{k}={v}" for k, v in new.items() if isinstance(v, int) and k not in ("exported", "expected", "pushes"))
+                print(f"  {scenario:<8} {label:<24} {key:<18} {change:+.1%}")
+
+
+async def run(args, base_url: str) -> dict:
+    import uvicorn
+    import index
+
+    server = uvicorn.Server(uvicorn.Config(index.app, host="127.0.0.1", port=int(base_url.rsplit(":", 1)[1]), log_level="warning"))
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    quick = (lambda sweep: sweep[:2]) if args.quick else (lambda sweep: sweep)
+    results = {}
+    try:
+        async with httpx.AsyncClient(base_url=base_url, timeout=WAIT_TIMEOUT, limits=httpx.Limits(max_connections=SETUP_CONCURRENCY)) as client:
+            api = Api(client)
+            if "publish" in args.only:
+                results["publish"] = await bench_publish(api, quick(PUBLISH_SUBSCRIBERS), args.rounds)
+            if "listing" in args.only:
+                results["listing"] = await bench_listing(api, quick(LISTING_SIZES), args.rounds)
+            if "sse" in args.only:
+                results["sse"] = await bench_sse(api, base_url, quick(SSE_CONNECTIONS), args.rounds)
+            if "push" in args.only:
+                results["push"] = await bench_push(api, quick(PUSH_DEVICES), args.rounds, args.apns_latency)
+            if "coalesce" in args.only:
+                results["coalesce"] = await bench_coalesce(api, quick(COALESCE_POSTBOXES), args.apns_latency)
+    finally:
+        server.should_exit = True
+        await serving
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark publish, fan-out, listing, realtime and push paths on this machine")
+    parser.add_argument("--mongo", help="use this server instead of a throwaway mongod, its `ondb` database gets benchmark data")
+    parser.add_argument("--only", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--rounds", type=int, default=ROUNDS)
+    parser.add_argument("--quick", action="store_true", help="only the two smallest points of every sweep")
+    parser.add_argument("--apns-latency", type=float, default=0.0, help="seconds the fake APNs waits before answering")
+    parser.add_argument("--output", help="where to save results, bench-<revision>.json by default")
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    mongod = None
+    url = args.mongo
+    if url is None:
+        mongod = Mongod()
+        url = mongod.start()
+    try:
+        client = pymongo.MongoClient(url)
+        if "messages" not in client.ondb.list_collection_names():
+            # same capped collection the docker init script creates, tailing needs it
+            client.ondb.create_collection("messages", capped=True, size=100000000)
+        client.close()
+        DB.url = url
+        started_at = time.time()
+        results = asyncio.run(run(args, f"http://127.0.0.1:{free_port()}"))
+    finally:
+        if mongod is not None:
+            mongod.stop()
+
+    revision = git_revision()
+    report = {"revision": revision, "started_at": started_at, "duration": time.time() - started_at,
+              "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+              "rounds": args.rounds, "quick": args.quick, "apns_latency": args.apns_latency, "results": results}
+    output = args.output or f"bench-{revision}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
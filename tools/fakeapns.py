@@ -0,0 +1,113 @@
+import argparse
+import asyncio
+import json
+
+from aioapns import APNs
+from aioapns.connection import APNsProductionClientProtocol
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.events import ConnectionTerminated, DataReceived, RequestReceived, StreamEnded
+
+# tokens starting with this are answered like devices that uninstalled the app
+GONE_PREFIX = "gone"
+
+
+# cleartext HTTP/2 server answering like api.push.apple.com, counts every request it sees
+class FakeAPNs:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.requests = 0
+        self.tokens: dict[str, int] = {}
+        self.server: asyncio.AbstractServer | None = None
+        self.port = 0
+
+    async def start(self, port: int = 0) -> int:
+        self.server = await asyncio.get_running_loop().create_server(lambda: FakeAPNsProtocol(self), "127.0.0.1", port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+
+    def reset(self):
+        self.requests = 0
+        self.tokens = {}
+
+    def answer(self, path: str) -> tuple[int, dict | None]:
+        token = path.rsplit("/", 1)[-1]
+        self.requests += 1
+        self.tokens[token] = self.tokens.get(token, 0) + 1
+        if token.startswith(GONE_PREFIX):
+            return 410, {"reason": "Unregistered", "timestamp": 0}
+        return 200, None
+
+
+class FakeAPNsProtocol(asyncio.Protocol):
+    def __init__(self, fake: FakeAPNs):
+        self.fake = fake
+        self.conn = H2Connection(H2Configuration(client_side=False))
+        self.transport: asyncio.Transport | None = None
+        self.streams: dict[int, list] = {}
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data: bytes):
+        for event in self.conn.receive_data(data):
+            if isinstance(event, RequestReceived):
+                self.streams[event.stream_id] = [dict(event.headers)]
+            elif isinstance(event, DataReceived):
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, StreamEnded):
+                headers = self.streams.pop(event.stream_id)[0]
+                asyncio.get_running_loop().create_task(self.respond(event.stream_id, headers))
+            elif isinstance(event, ConnectionTerminated):
+                self.transport.close()
+        self.flush()
+
+    async def respond(self, stream_id: int, headers: dict):
+        if self.fake.latency:
+            await asyncio.sleep(self.fake.latency)
+        status, body = self.fake.answer(headers[b":path"].decode())
+        response = [(":status", str(status)), ("apns-id", headers[b"apns-id"].decode())]
+        if body is None:
+            self.conn.send_headers(stream_id, response, end_stream=True)
+        else:
+            self.conn.send_headers(stream_id, response)
+            self.conn.send_data(stream_id, json.dumps(body).encode(), end_stream=True)
+        self.flush()
+
+    def flush(self):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(self.conn.data_to_send())
+
+
+def create_client(port: int, topic: str = "com.example.bench", max_connections: int = 4) -> APNs:
+    # a real aioapns client with a throwaway signing key, pointed at the fake server over plain TCP
+    key = ec.generate_private_key(ec.SECP256R1()).private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode()
+    client = APNs(key=key, key_id="BENCHKEY00", team_id="BENCHTEAM0", topic=topic, max_connections=max_connections)
+    client.pool.protocol_class = type("FakeAPNsClientProtocol", (APNsProductionClientProtocol,),
+                                      {"APNS_SERVER": "127.0.0.1", "APNS_PORT": port})
+    client.pool.ssl_context = None
+    return client
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run a fake APNs endpoint (cleartext HTTP/2)")
+    parser.add_argument("--port", type=int, default=2197)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before every answer")
+    args = parser.parse_args()
+    fake = FakeAPNs(args.latency)
+    port = await fake.start(args.port)
+    print(f"Fake APNs listening on 127.0.0.1:{port}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
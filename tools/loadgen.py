@@ -0,0 +1,299 @@
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import secrets
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+import httpx
+
+from tools.stats import summarize
+
+# requests in flight while building the population
+SETUP_CONCURRENCY = 50
+# publish requests in flight, a slower server makes the generator fall behind schedule instead of queueing more
+PUBLISH_CONCURRENCY = 100
+# after the last publish, listeners get this long to receive what is still on its way
+DRAIN_TIMEOUT = 10
+# listeners sharing one account, matches the server's default STREAMS_PER_ACCOUNT
+STREAMS_PER_ACCOUNT = 20
+WORDS = ["alert", "build", "deploy", "digest", "invoice", "news", "order", "report", "review", "status", "ticket", "weekly"]
+
+
+@dataclass
+class Population:
+    # publisher account -> its subscription unique ids, subscriber account -> unique ids it follows
+    publishers: dict[str, list[str]] = field(default_factory=dict)
+    subscribers: dict[str, list[str]] = field(default_factory=dict)
+    owners: dict[str, str] = field(default_factory=dict)
+    followers: dict[str, list[str]] = field(default_factory=lambda: defaultdict(list))
+    devices: int = 0
+
+
+class Api:
+    def __init__(self, client: httpx.AsyncClient):
+        self.client = client
+        self.setup = asyncio.Semaphore(SETUP_CONCURRENCY)
+
+    async def post(self, path: str, **body) -> dict:
+        async with self.setup:
+            res = await self.client.post(path, json=body)
+        res.raise_for_status()
+        return res.json() if res.content else {}
+
+    async def create_account(self) -> str:
+        return (await self.post("/v1/accounts/"))["account_id"]
+
+
+def words(rng: random.Random, count: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+async def build_population(api: Api, args, rng: random.Random) -> Population:
+    population = Population()
+    # unique ids are global, a rerun with the same seed must not collide with the last population
+    run_id = secrets.token_hex(3)
+    publishers = await asyncio.gather(*(api.create_account() for _ in range(args.publishers)))
+    for publisher in publishers:
+        population.publishers[publisher] = []
+    unique_ids = [f"lg-{run_id}-{i}" for i in range(args.publishers * args.subscriptions)]
+    await asyncio.gather(*(api.post("/v1/subscriptions/", account_id=publishers[i % args.publishers], unique_id=unique_id,
+                                    meta={"sender": f"loadgen {i % args.publishers}"})
+                           for i, unique_id in enumerate(unique_ids)))
+    for i, unique_id in enumerate(unique_ids):
+        population.publishers[publishers[i % args.publishers]].append(unique_id)
+        population.owners[unique_id] = publishers[i % args.publishers]
+    print(f"{len(publishers)} publishers with {len(unique_ids)} subscriptions")
+
+    # a few subscriptions are followed by most accounts, like real feeds
+    weights = [1 / (rank + 1) ** args.skew for rank in range(len(unique_ids))]
+    subscribers = await asyncio.gather(*(api.create_account() for _ in range(args.subscribers)))
+
+    async def subscribe(account: str, follows: list[str]):
+        # one account at a time, every subscribe rewrites its postbox list
+        for unique_id in follows:
+            await api.post(f"/v1/accounts/{account}/subscriptions", unique_id=unique_id)
+        for i in range(args.devices):
+            await api.post(f"/v1/accounts/{account}/devices", device_id=f"loadgen{account}{i:04x}", device_type="ios")
+
+    plans = []
+    for account in subscribers:
+        follows = set()
+        while len(follows) < min(args.follows, len(unique_ids)):
+            follows.add(rng.choices(unique_ids, weights)[0])
+        plans.append((account, sorted(follows)))
+    await asyncio.gather(*(subscribe(account, follows) for account, follows in plans))
+    for account, follows in plans:
+        population.subscribers[account] = follows
+        for unique_id in follows:
+            population.followers[unique_id].append(account)
+    population.devices = args.subscribers * args.devices
+    print(f"{len(subscribers)} subscribers following {args.follows} each, {population.devices} devices")
+    return population
+
+
+class Listeners:
+    def __init__(self, client: httpx.AsyncClient, population: Population, count: int):
+        self.client = client
+        self.sent: dict[str, float] = {}
+        self.latencies: list[float] = []
+        self.per_account: dict[str, int] = defaultdict(int)
+        self.connected = 0
+        self.failed = 0
+        self.received = 0
+        self.ready = asyncio.Event()
+        accounts = list(population.subscribers)
+        self.targets = list(itertools.islice(itertools.cycle(accounts), min(count, len(accounts) * STREAMS_PER_ACCOUNT)))
+        self.tasks: list[asyncio.Task] = []
+
+    async def listen(self, account: str):
+        try:
+            async with self.client.stream("GET", f"/v1/realtime/accounts/{account}/messages") as res:
+                if res.status_code != 200:
+                    self.failed += 1
+                    return
+                self.per_account[account] += 1
+                self.connected += 1
+                if self.connected + self.failed == len(self.targets):
+                    self.ready.set()
+                async for line in res.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    # the publish time travels in the subject, no clock to share with the server
+                    token = json.loads(line[5:]).get("subject", "")
+                    if token in self.sent:
+                        self.latencies.append(time.perf_counter() - self.sent[token])
+                        self.received += 1
+        except httpx.HTTPError:
+            self.failed += 1
+        finally:
+            if self.connected + self.failed == len(self.targets):
+                self.ready.set()
+
+    async def start(self, timeout: float):
+        self.tasks = [asyncio.create_task(self.listen(account)) for account in self.targets]
+        if not self.tasks:
+            return
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        # streams join the hub when their generator starts, just after the headers went out
+        await asyncio.sleep(0.5)
+        print(f"{self.connected} listeners connected, {self.failed} refused or failed")
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+class Publisher:
+    def __init__(self, client: httpx.AsyncClient, population: Population, listeners: Listeners, rng: random.Random, args):
+        self.client = client
+        self.population = population
+        self.listeners = listeners
+        self.rng = rng
+        self.args = args
+        self.unique_ids = list(population.owners)
+        self.weights = [1 / (rank + 1) ** args.skew for rank in range(len(self.unique_ids))]
+        self.slots = asyncio.Semaphore(PUBLISH_CONCURRENCY)
+        self.latencies: list[float] = []
+        self.statuses: dict[str, int] = defaultdict(int)
+        self.accepted = 0
+        self.expected = 0
+        self.late = 0
+        self.seq = 0
+
+    def message(self, unique_id: str) -> dict:
+        self.seq += 1
+        token = f"loadgen {self.seq}"
+        self.expected += sum(self.listeners.per_account.get(account, 0) for account in self.population.followers[unique_id])
+        return {"unique_id": unique_id, "subject": token, "body": words(self.rng, self.args.words),
+                "important": self.rng.random() < self.args.important}
+
+    async def send(self, scheduled: float):
+        # a batch goes to one publisher, spread over its subscriptions by popularity
+        publisher = self.population.owners[self.rng.choices(self.unique_ids, self.weights)[0]]
+        own = self.population.publishers[publisher]
+        messages = [self.message(self.rng.choice(own)) for _ in range(self.args.batch)]
+        async with self.slots:
+            sent = time.perf_counter()
+            for message in messages:
+                self.listeners.sent[message["subject"]] = sent
+            try:
+                if self.args.batch == 1:
+                    message = {k: v for k, v in messages[0].items() if k != "unique_id"}
+                    res = await self.client.post(f"/v1/accounts/{publisher}/subscriptions/{messages[0]['unique_id']}", json=message)
+                else:
+                    res = await self.client.post(f"/v1/accounts/{publisher}/publish", json={"messages": messages})
+                status = str(res.status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+        # measured from when the request was due, a stalled server can't hide the wait (coordinated omission)
+        self.latencies.append(time.perf_counter() - scheduled)
+        self.statuses[status] += 1
+        if status == "202":
+            self.accepted += len(messages)
+        else:
+            for message in messages:
+                self.listeners.sent.pop(message["subject"], None)
+            self.expected -= sum(self.listeners.per_account.get(account, 0)
+                                 for message in messages for account in self.population.followers[message["unique_id"]])
+
+    async def run(self, rate: float, duration: float):
+        interval = self.args.batch / rate
+        started = time.perf_counter()
+        pending = set()
+        for i in itertools.count():
+            scheduled = started + i * interval
+            if scheduled - started >= duration:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -interval:
+                self.late += 1
+            task = asyncio.create_task(self.send(scheduled))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        await asyncio.gather(*pending)
+        return time.perf_counter() - started
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=PUBLISH_CONCURRENCY)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client, \
+            httpx.AsyncClient(base_url=args.url, timeout=httpx.Timeout(None, connect=args.timeout), limits=limits) as streams:
+        (await client.get("/v1/ready")).raise_for_status()
+        started = time.perf_counter()
+        population = await build_population(Api(client), args, rng)
+        setup = time.perf_counter() - started
+
+        listeners = Listeners(streams, population, args.listeners)
+        await listeners.start(args.timeout)
+        publisher = Publisher(client, population, listeners, rng, args)
+        elapsed = await publisher.run(args.rate, args.duration)
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while listeners.received < publisher.expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        await listeners.stop()
+
+    return {
+        "url": args.url,
+        "population": {"publishers": args.publishers, "subscriptions": len(population.owners), "subscribers": args.subscribers,
+                       "follows": args.follows, "devices": population.devices, "setup_s": setup},
+        "publish": {"rate": args.rate, "batch": args.batch, "duration_s": elapsed, "statuses": dict(publisher.statuses),
+                    "accepted": publisher.accepted, "accepted_per_second": publisher.accepted / elapsed,
+                    "late": publisher.late, "latency": summarize(publisher.latencies)},
+        "sse": {"listeners": listeners.connected, "refused": listeners.failed, "expected": publisher.expected,
+                "delivered": listeners.received, "delivered_per_second": listeners.received / elapsed,
+                "latency": summarize(listeners.latencies)},
+    }
+
+
+def report(results: dict):
+    publish, sse = results["publish"], results["sse"]
+    print(f"publish  {publish['accepted']} messages accepted, {publish['accepted_per_second']:.0f}/s, statuses {publish['statuses']}, "
+          f"{publish['late']} sent late")
+    print("         request p50={p50_ms:.1f}ms p95={p95_ms:.1f}ms p99={p99_ms:.1f}ms".format(**publish["latency"])
+          if publish["latency"]["n"] else "         no requests")
+    print(f"sse      {sse['delivered']}/{sse['expected']} delivered to {sse['listeners']} listeners, {sse['delivered_per_second']:.0f}/s")
+    if sse["latency"]["n"]:
+        print("         publish to SSE p50={p50_ms:.1f}ms p95={p95_ms:.1f}ms p99={p99_ms:.1f}ms max={max_ms:.1f}ms".format(**sse["latency"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a synthetic population on a running instance and drive publish and realtime load")
+    parser.add_argument("--url", default="http://127.0.0.1:8080", help="instance under load, its database gets the population")
+    parser.add_argument("--publishers", type=int, default=10)
+    parser.add_argument("--subscriptions", type=int, default=5, help="subscriptions per publisher")
+    parser.add_argument("--subscribers", type=int, default=1000, help="accounts following subscriptions")
+    parser.add_argument("--follows", type=int, default=3, help="subscriptions every subscriber follows")
+    parser.add_argument("--devices", type=int, default=1, help="push devices per subscriber")
+    parser.add_argument("--skew", type=float, default=1.0, help="zipf exponent of subscription popularity, 0 for uniform")
+    parser.add_argument("--listeners", type=int, default=100, help="concurrent SSE streams, spread over the subscribers")
+    parser.add_argument("--rate", type=float, default=20, help="messages published per second")
+    parser.add_argument("--batch", type=int, default=1, help="messages per publish request, more than 1 uses /publish")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of publishing")
+    parser.add_argument("--important", type=float, default=0.05, help="share of important messages")
+    parser.add_argument("--words", type=int, default=12, help="words in a message body")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="save results as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+import statistics
+
+
+def summarize(samples: list[float]) -> dict:
+    samples = sorted(samples)
+    if not samples:
+        return {"n": 0}
+
+    def pick(q: float) -> float:
+        return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+
+    return {"n": len(samples), "mean_ms": statistics.fmean(samples) * 1000,
+            "p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": samples[-1] * 1000}